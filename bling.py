@@ -1,4 +1,9 @@
 
+import functools
+import queue
+import threading
+from collections import namedtuple
+
 from bibliopixel import Strip
 
 from logger import logger
@@ -11,10 +16,37 @@ from bibliopixel.drivers.SPI.LPD8806 import *
 from bibliopixel.drivers.spi_interfaces import SPI_INTERFACES
 
 import bling_patterns
+from bling_framebuffer import FrameCache
+from bling_renderer import BlingRenderer
+
+#
+# Immutable bling command, parsed from a command string such as 'Pattern=Blinking,Color=GREEN'.
+# The parameters left out of the command keep their default setting, and a Brightness of None
+# stands for the default brightness of the strip.
+#
+BlingSpec = namedtuple('BlingSpec', ['Pattern', 'Segment', 'Color', 'Speed', 'Min', 'Max', 'Brightness'])
+
+DEFAULT_SPEC = BlingSpec( Pattern='Error', Segment='All', Color='Error', Speed='Medium', Min='0', Max='100',
+                          Brightness=None )
+
+#
+# Parse a command string into a BlingSpec. The robot state machine sends the same few commands
+# over and over, so the specs are memoized. Raises ValueError for a malformed parameter.
+#
+@functools.lru_cache(maxsize=64)
+def parse_cmd(cmd_str):
+    params = {}
+    for param in cmd_str.split(','):
+        name,value = param.split('=')
+        name = name.title()
+        if name in BlingSpec._fields:
+            params[name] = value.upper()
+    return DEFAULT_SPEC._replace(**params)
 
 class Bling(object):
 
-    def __init__(self, num_leds, num_segments=None, brightness=127, ledtype='LPD8806', comms='SPI', dev='/dev/spidev0.0'):
+    def __init__(self, num_leds, num_segments=None, brightness=127, ledtype='LPD8806', comms='SPI', dev='/dev/spidev0.0',
+                 frame_cache_bytes=4*1024*1024, fade_time=0.0):
 
         # set the total number of LEDs in the strip
         self.num_leds = num_leds
@@ -55,20 +87,35 @@ class Bling(object):
         # but we have only a single strip at this time
         self.layout = Strip(self.driver, threadedUpdate=True, brightness=self.brightness)
 
+        # the one thread that renders the animation of the current pattern, optionally cross-fading
+        # over fade_time seconds from one pattern to the next
+        self.renderer = BlingRenderer(self.layout, fade_time)
+
         # the frames per second is used to control how fast the animation runs. some of the animations
         # work better when run at a low frames per second
         self.fps = None
 
         # the pattern variable contains the most recent bling pattern that has been assigned
         self.pattern = None
+
+        # spec of the command currently shown on the LEDs, None once the animation is stopped
+        self.spec = None
         
         # initialize the bling command parameters to provide reasonable default values for each
         # setting
         self.params = {}
         self.init_params()
+
+        # commands submitted by the controller, processed by the bling worker thread
+        self.commands = queue.Queue()
+        self.worker = None
         
         self.bling_patterns = bling_patterns.BlingPatterns(self)
 
+        # rendered periods of the periodic patterns, played back instead of running their
+        # animation every time the pattern is selected again
+        self.frame_cache = FrameCache(frame_cache_bytes)
+
         ###### TODO: remove these variables after converting the menu processing to use #####
         ######       the new patterns                                                   #####
         # animation object containing pattern to apply to the LEDs
@@ -98,6 +145,8 @@ class Bling(object):
         self.brightness = level
 
     def stop_animation(self):
+        self.spec = None
+
         # reset the brightness level back to the default value that was set upon initialization
         self.layout.set_brightness(self.brightness)
 
@@ -107,8 +156,7 @@ class Bling(object):
             if self.anim is not None:
                 self.anim.join()
                 self.anim.stop()
-            self.layout.all_off()
-            self.layout.update()
+            self.renderer.play(None)
 
     def get_leds_from_segment(self, segment_str):
         segment_leds = [0,-1]
@@ -122,14 +170,10 @@ class Bling(object):
             segment_leds = [0,-1]
         return segment_leds
 
-    def init_params(self):
-        self.params['Pattern'] = 'Error'
-        self.params['Segment'] = 'All'
-        self.params['Color'] = 'Error'
-        self.params['Speed'] = 'Medium'
-        self.params['Min'] = '0'
-        self.params['Max'] = '100'
-        self.params['Brightness'] = str(self.brightness)
+    def init_params(self, spec=DEFAULT_SPEC):
+        self.params = spec._asdict()
+        if spec.Brightness is None:
+            self.params['Brightness'] = str(self.brightness)
 
     def apply_min_max_params(self, leds):
         # Re-calculate the minimum and maximum LED values by applying any
@@ -155,25 +199,30 @@ class Bling(object):
         return leds
     
     def process_cmd(self, cmd_str):
+        # Parse command string into parameter list
+        logger.debug( 'Command: %s' % cmd_str )
+        return self.process_spec( parse_cmd(cmd_str) )
+
+    def process_spec(self, spec):
         result = 'OK'
 
-        # start by starting any animation that is already running
-        self.stop_animation()
+        if spec == self.spec:
+            # the LEDs already show this command, leave the animation running undisturbed
+            return result
 
-        # re-initialize the animation parameters to the default settings
-        self.init_params()
+        # the animation that is already running carries on until the renderer switches to the
+        # new one, so the LEDs don't go dark in between
+        self.spec = None
+        self.layout.set_brightness(self.brightness)
+
+        # set the animation parameters from the command, defaulting the ones it leaves out
+        self.init_params(spec)
         
         try:
-            # Parse command string into parameter list
-            logger.debug( 'Command: %s' % cmd_str )
-            cmd_params=cmd_str.split(',')
-            for param in cmd_params:
-                name,value=param.split('=')
-                self.params[name.title()] = value.upper()
-    
             if self.params['Pattern'] == 'OFF':
-                # if the patter is OFF, then simply return. we have already turned off
-                # the LEDs
+                # if the patter is OFF, then simply turn off the LEDs and return
+                self.stop_animation()
+                self.spec = spec
                 return result
 
             # process the command based on the provided parameters
@@ -198,6 +247,7 @@ class Bling(object):
 
             # run the configured pattern
             self.pattern.run()
+            self.spec = spec
     
         except:
             raise
@@ -211,6 +261,49 @@ class Bling(object):
 
         return result
 
+    def submit_cmd(self, cmd_str):
+        #
+        # queue a command for the bling worker thread and return right away, so that the caller
+        # never waits for an animation to stop or for the strip to be updated. The worker is
+        # started with the first command
+        #
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.process_commands, name='bling', daemon=True)
+            self.worker.start()
+        self.commands.put( cmd_str )
+
+    def process_commands(self):
+        while True:
+            pending = [ self.commands.get() ]
+            try:
+                while True:
+                    pending.append( self.commands.get_nowait() )
+            except queue.Empty:
+                pass
+
+            # each command replaces the pattern of the one before it, so only the latest one of
+            # a burst is worth showing. None asks the worker to exit once it has been shown
+            cmds = [ cmd_str for cmd_str in pending if cmd_str is not None ]
+            if cmds:
+                try:
+                    self.process_cmd( cmds[-1] )
+                except Exception as err:
+                    logger.error( 'Error processing command: %s: %s' % (cmds[-1], err) )
+            if None in pending:
+                return
+
+    def close(self, timeout=5.0):
+        # wait for the worker to finish the commands already submitted, and stop it along with
+        # the render thread
+        if self.worker is not None:
+            self.commands.put( None )
+            self.worker.join( timeout )
+            self.worker = None
+        self.renderer.stop( timeout )
+        stats = self.renderer.frame_stats()
+        logger.info( 'Bling frames sent: %d, skipped: %d, changed LEDs: %d' %
+                     (stats['sent'], stats['skipped'], stats['changed_leds']) )
+
  
     # TODO: Most of the following code will be removed once we complete the implementation of the pattern
     # classes and convert the menu over to using the pattern classes insead
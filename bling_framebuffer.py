@@ -0,0 +1,213 @@
+from collections import OrderedDict
+
+import numpy as np
+
+#
+# Framebuffer rendering for the bling animations. Instead of setting the LEDs of the layout one
+# at a time from nested loops, an animation computes its frame as an (N, 3) uint8 array using
+# vectorized operations and hands the whole array to the layout at once.
+#
+# The segment animations show the same pattern on each segment of the strip. They draw a single
+# segment, which SegmentFrame then copies to every segment through a (segments, size, 3) view of
+# the frame, so the cost of a frame hardly depends on the number of segments.
+#
+
+#
+# Copy a frame to the color list of a layout, starting at the given LED. The color list is a
+# numpy array when the layout was created with a numpy data maker, otherwise a list of tuples
+#
+def write_frame(layout, frame, offset=0):
+    color_list = layout.color_list
+    count = min( len(frame), len(color_list) - offset )
+    if count <= 0:
+        return
+    if isinstance(color_list, np.ndarray):
+        color_list[offset:offset+count] = frame[:count]
+    else:
+        color_list[offset:offset+count] = list( zip(*frame[:count].T.tolist()) )
+
+#
+# Vectorized color_scale(): the color scaled by each of the levels (0-256), one row per level
+#
+def scale_colors(color, levels):
+    scaled = np.asarray(color, dtype=np.float64)[np.newaxis, :] * np.asarray(levels)[:, np.newaxis]
+    return scaled.astype(np.int64) >> 8
+
+#
+# Vectorized Palette.get(): the colors of a BiblioPixel palette at each of the positions, with
+# the same scaling, wrapping and interpolation as the palette applies to a single position
+#
+def palette_colors(palette, positions):
+    colors = np.array( palette, dtype=np.float64 ).reshape(-1, 3)
+    positions = np.asarray( positions, dtype=np.float64 )
+    n = len(colors)
+    if n == 1:
+        return np.broadcast_to( colors[0], positions.shape + (3,) ).astype(np.uint8)
+
+    if palette.length and palette.autoscale:
+        positions = positions * n / palette.length
+    positions = positions * palette.scale + palette.offset
+
+    if not palette.continuous:
+        if not palette.serpentine:
+            return colors[ (positions % n).astype(np.intp) ].astype(np.uint8)
+        m = (2 * n) - 2
+        positions = positions % m
+        index = np.where( positions < n, positions, m - positions ).astype(np.intp)
+        return colors[index].astype(np.uint8)
+
+    if palette.serpentine:
+        positions = positions % (2 * n)
+        positions = np.where( positions > n, (2 * n) - positions, positions )
+    else:
+        positions = positions % n
+
+    positions = positions * (n - 1) / n
+    index = positions.astype(np.intp)
+    fade = (positions - index)[..., np.newaxis]
+    lower = colors[index]
+    upper = colors[(index + 1) % n]
+    # Palette.get() returns the blended color as floats, round them rather than truncating
+    return np.rint(lower + fade * (upper - lower)).astype(np.uint8)
+
+#
+# Frame of a layout made up of num_segments segments of segment_size LEDs. The animation draws
+# into segment, and render() replicates it across the segments and writes the frame to the
+# layout. Any LEDs past the last full segment stay off.
+#
+class SegmentFrame(object):
+    def __init__(self, num_leds, num_segments, segment_size):
+        self.num_segments = num_segments
+        self.segment_size = segment_size
+        self.pixels = np.zeros( (num_leds, 3), dtype=np.uint8 )
+        self.segment = np.zeros( (segment_size, 3), dtype=np.uint8 )
+        self.segments = self.pixels[:num_segments*segment_size].reshape( num_segments, segment_size, 3 )
+
+    def clear(self):
+        self.segment[:] = 0
+
+    def render(self, layout):
+        self.segments[:] = self.segment
+        write_frame( layout, self.pixels )
+
+#
+# Render one period of an animation, num_frames frames long, returning the frames as a single
+# contiguous (num_frames, N, 3) uint8 array. The animation is run from its first frame on a
+# scratch copy of its layout, so the live strip isn't touched. One more frame is rendered to
+# check that the animation really is back at its first frame; if it isn't, None is returned
+#
+def render_period(animation, num_frames):
+    layout = animation.layout
+    scratch = layout.clone()
+    scratch.all_off()
+    frames = np.empty( (num_frames + 1, scratch.numLEDs, 3), dtype=np.uint8 )
+
+    animation.layout = scratch
+    try:
+        animation.pre_run()
+        for index in range(num_frames + 1):
+            animation.step()
+            frames[index] = scratch.color_list
+    finally:
+        animation.layout = layout
+        animation.pre_run()
+
+    if not np.array_equal( frames[0], frames[num_frames] ):
+        return None
+    return np.frombuffer( frames[:num_frames].tobytes(), dtype=np.uint8 ).reshape( num_frames, scratch.numLEDs, 3 )
+
+#
+# FrameCache keeps the rendered periods of the most recently used animations, keyed by the
+# pattern settings that determine the frames. The total size of the frames is bounded by
+# max_bytes, evicting the least recently used periods first.
+#
+class FrameCache(object):
+    def __init__(self, max_bytes=4*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        frames = self.entries.get(key, None)
+        if frames is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end( key )
+        return frames
+
+    def put(self, key, frames):
+        if frames.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key).nbytes
+        while self.entries and self.num_bytes + frames.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem( last=False )
+            self.num_bytes -= evicted.nbytes
+        self.entries[key] = frames
+        self.num_bytes += frames.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+#
+# FrameDiff compares each outgoing frame with the last frame sent to the strip, so that a frame
+# that is identical to it isn't sent again. A change of brightness counts as a change, as the
+# driver only applies it when a frame is sent.
+#
+# For a frame that did change, the LEDs are compared in blocks of range_size and dirty_ranges
+# holds the (first, last) LEDs of each run of changed blocks, showing how sparse the changes are.
+# The counters cover all frames since the FrameDiff was created, with every LED counted as
+# changed in a frame that is sent in full (the first frame, or after a change of brightness).
+#
+class FrameDiff(object):
+    def __init__(self, range_size=16):
+        self.range_size = range_size
+        self.last_frame = None
+        self.last_brightness = None
+        self.dirty_ranges = []
+        self.num_sent = 0
+        self.num_skipped = 0
+        self.num_changed_leds = 0
+
+    def changed(self, color_list, brightness=None):
+        # True if the frame has to be sent, in which case it becomes the last frame sent
+        frame = np.asarray( color_list ).astype( np.uint8 )
+        if self.last_frame is None or self.last_frame.shape != frame.shape:
+            self.dirty_ranges = [ (0, len(frame) - 1) ] if len(frame) else []
+            num_changed = len(frame)
+        elif brightness != self.last_brightness:
+            self.dirty_ranges = [ (0, len(frame) - 1) ]
+            num_changed = len(frame)
+        else:
+            leds = np.any( frame != self.last_frame, axis=1 )
+            if not leds.any():
+                self.num_skipped += 1
+                return False
+            self.dirty_ranges = self.find_ranges( leds )
+            num_changed = int( leds.sum() )
+
+        self.last_frame = frame
+        self.last_brightness = brightness
+        self.num_sent += 1
+        self.num_changed_leds += num_changed
+        return True
+
+    def find_ranges(self, leds):
+        blocks = np.logical_or.reduceat( leds, np.arange(0, len(leds), self.range_size) )
+        edges = np.diff( np.concatenate(([False], blocks, [False])).astype(np.int8) )
+        starts = np.flatnonzero( edges == 1 )
+        ends = np.flatnonzero( edges == -1 )
+        return [ (int(start) * self.range_size, min(int(end) * self.range_size, len(leds)) - 1)
+                 for start, end in zip(starts, ends) ]
+
+    def stats(self):
+        return { 'sent': self.num_sent,
+                 'skipped': self.num_skipped,
+                 'changed_leds': self.num_changed_leds }
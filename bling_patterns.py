@@ -13,9 +13,9 @@ from bibliopixel.animation import StripChannelTest
 from bibliopixel.animation.strip import Strip
 
 from bibliopixel.colors import colors
-from bibliopixel.colors.arithmetic import color_scale
 
 import math
+import numpy as np
 
 from BiblioPixelAnimations.strip import Alternates
 from BiblioPixelAnimations.strip import Rainbows
@@ -35,13 +35,17 @@ from BiblioPixelAnimations.strip import Wave
 # import the bling color map that defines all of our supported color schemes
 import bling_colors
 
+from bling_framebuffer import SegmentFrame, write_frame, scale_colors, palette_colors, render_period
+
 # a constant specifying the number of LEDs for a default width. We may want to expose the width 
 # as a parameter in the interface from the robot code, too
 DEFAULT_WIDTH=3
 DEFAULT_CYCLES=5
 
 # Modified Larson Scanner class to handle multiple segments within a LED strip. This
-# class will display the same pattern on each of the segments
+# class will display the same pattern on each of the segments. Like the other segment
+# animations below, each frame is drawn into a SegmentFrame (see bling_framebuffer.py) and
+# written to the layout in one go
 class SegmentLarsonScanner(Strip):
 
     def __init__(self, layout, num_segments, segment_size, color, tail=2, start=0, end=-1, **kwds):
@@ -58,31 +62,31 @@ class SegmentLarsonScanner(Strip):
         self._num_segments = num_segments
         self._segment_size = segment_size
 
+        # distance from the head of each LED of the tail, and the level it is faded to
+        self._offsets = np.arange(self._tail)
+        self._levels = 255 - (self._fadeAmt * self._offsets)
+        self._frame = SegmentFrame(self.layout.numLEDs, num_segments, segment_size)
+
     def pre_run(self):
         self._direction = -1
         self._last = 0
         self._step = 0
 
     def step(self, amt=1):
-        self.layout.all_off()
-
         self._last = self._start + self._step
         color = self._get_color()
 
-        for j in range(0,self._num_segments):
-            self.layout.set((j*self._segment_size)+self._last, color)
-
-        for i in range(self._tail):
-            c2 = color_scale(color, 255 - (self._fadeAmt * i))
-            for j in range(0,self._num_segments):
-                base_led = j*self._segment_size
-                top_led = (j+1)*self._segment_size
-                lower_led = base_led+self._last - i
-                if lower_led >= base_led:
-                    self.layout.set(lower_led, c2)
-                upper_led = base_led+self._last + i
-                if upper_led < top_led:
-                    self.layout.set(upper_led, c2)
+        # the head and the tail on either side of it, clipped to the segment
+        segment = self._frame.segment
+        segment[:] = 0
+        faded = scale_colors(color, self._levels)
+        lower = self._last - self._offsets
+        inside = (lower >= 0) & (lower < self._segment_size)
+        segment[lower[inside]] = faded[inside]
+        upper = self._last + self._offsets
+        inside = (upper >= 0) & (upper < self._segment_size)
+        segment[upper[inside]] = faded[inside]
+        self._frame.render(self.layout)
 
         if self._start + self._step >= self._segment_size-1:
             self._direction = -self._direction
@@ -114,14 +118,17 @@ class SegmentColorWipe(Strip):
         self._color = color
         self._num_segments = num_segments
         self._segment_size = segment_size
+        self._frame = SegmentFrame(self.layout.numLEDs, num_segments, segment_size)
 
     def step(self, amt = 1):
+        # the wipe accumulates in the segment until it starts over
+        segment = self._frame.segment
         if self._step == 0:
-            self._led.all_off()
+            segment[:] = 0
 
-        for i in range(amt):
-            for j in range(0,self._num_segments):
-                self._led.set((j*self._segment_size)+self._start + self._step - i, self._color)
+        leds = self._start + self._step - np.arange(amt)
+        segment[leds[(leds >= 0) & (leds < self._segment_size)]] = self._color
+        self._frame.render(self.layout)
 
         self._step += amt
         overflow = (self._start + self._step) - (self._segment_size)
@@ -137,13 +144,17 @@ class SegmentColorChase(Strip):
         self._width = width
         self._num_segments = num_segments
         self._segment_size = segment_size
+        self._frame = SegmentFrame(self.layout.numLEDs, num_segments, segment_size)
 
-    def step(self, amt = 1):
-        self._led.all_off() #because I am lazy
+    def pre_run(self):
+        self._step = 0
 
-        for i in range(self._width):
-            for j in range(0,self._num_segments):
-                self._led.set((j*self._segment_size)+self._start + self._step - i, self._color)
+    def step(self, amt = 1):
+        # the tail wraps around to the end of its own segment
+        segment = self._frame.segment
+        segment[:] = 0
+        segment[(self._start + self._step - np.arange(self._width)) % self._segment_size] = self._color
+        self._frame.render(self.layout)
 
         self._step += amt
         overflow = (self._start + self._step) - (self._segment_size)
@@ -207,17 +218,21 @@ class SegmentLinearRainbow(Strip):
             self._maxLed = self.layout.numLEDs - 1
         self._num_segments = num_segments
         self._segment_size = segment_size
+        self._frame = SegmentFrame(self.layout.numLEDs, num_segments, segment_size)
 
         self._individualPixel = individual_pixel
 
     def step(self, amt=1):
-        for j in range(0,self._num_segments):
-            if self._individualPixel:
-                # This setting will change the colour of each pixel on each cycle
-                self.layout.fill(self.palette(self._step), (j*self._segment_size)+self._current, (j*self._segment_size)+self._current)
-            else:
-                # This setting will change the colour of all pixels on each cycle
-                self.layout.fill(colors.wheel_color(self._step), 0, self._current)
+        if self._individualPixel:
+            # This setting will change the colour of each pixel on each cycle
+            self._frame.segment[self._current] = self.palette(self._step)
+            self._frame.render(self.layout)
+        else:
+            # This setting will change the colour of all pixels on each cycle. As before, this
+            # only lights the absolute LEDs 0..current rather than each segment
+            pixels = self._frame.pixels[:self._current+1]
+            pixels[:] = colors.wheel_color(self._step)
+            write_frame(self.layout, pixels)
 
         self._step += amt
 
@@ -237,18 +252,69 @@ class SegmentColorPattern(Strip):
         self._dir = dir
         self._num_segments = num_segments
         self._segment_size = segment_size
+        self._frame = SegmentFrame(self.layout.numLEDs, num_segments, segment_size)
 
-    def step(self, amt = 1):
+        # the pattern only has total_width distinct colors, one for each offset into it
+        self._pattern = palette_colors(self.palette, np.arange(self._total_width) / self._width)
 
-        for i in range(self._size):
-            cIndex = ((i+self._step) % self._total_width) / self._width;
-            for j in range(0,self._num_segments):
-                led_index = (j*self._segment_size)+(i % self._segment_size)
-                self.layout.set(led_index, self.palette(cIndex))
+        # each LED of the segment shows the last of the pattern positions that wrap onto it
+        leds = np.arange(min(self._size, segment_size))
+        self._positions = leds + segment_size * ((self._size - 1 - leds) // segment_size)
+
+    def step(self, amt = 1):
+        segment = self._frame.segment
+        segment[:len(self._positions)] = self._pattern[(self._positions + self._step) % self._total_width]
+        self._frame.render(self.layout)
 
         self._step += amt * (1 if self._dir else -1)
 
 
+class FrameRainbowCycle(Strip):
+    """Rainbow wheel equally distributed over the strip, same as the RainbowCycle animation
+    but rendered as a whole frame, for the high frame rates of the RainbowCycle pattern."""
+
+    def __init__(self, layout, start=0, end=-1, **kwds):
+        super().__init__(layout, start, end, **kwds)
+        self._positions = np.arange(self._size) * 255 / self._size
+
+    def pre_run(self):
+        self._step = 0
+
+    def step(self, amt=1):
+        write_frame(self.layout, palette_colors(self.palette, self._positions + self._step), self._start)
+
+        self._step += amt
+        overflow = self._step - 256
+        if overflow >= 0:
+            self._step = overflow
+
+
+class SolidFill(Strip):
+    """Fill the LEDs with a single color, a frame that never changes."""
+
+    def __init__(self, layout, color, start=0, end=-1):
+        super().__init__(layout, start, end)
+        self._color = color
+
+    def step(self, amt=1):
+        self.layout.fill(self._color, self._start, self._end)
+
+
+class FramePlayback(Strip):
+    """Play back the frames of one period of an animation, rendered ahead of time."""
+
+    def __init__(self, layout, frames):
+        super().__init__(layout)
+        self._frames = frames
+
+    def pre_run(self):
+        self._step = 0
+
+    def step(self, amt=1):
+        write_frame(self.layout, self._frames[self._step])
+        self._step = (self._step + amt) % len(self._frames)
+
+
 #
 # Base class for the Bling patterns. This class contains the base behavior that is required for each of 
 # the patterns. The individual patterns will derive from this base class and override the 
@@ -262,6 +328,10 @@ class BlingPatternBase(object):
         self.speed_params = { 'SLOW': 0, 'MEDIUM': 0, 'FAST':0 }
         self.animation = None
         self.fps = 0
+
+        # number of frames after which the animation repeats itself, see set_period()
+        self.period = None
+        self.cache_key = None
     
     def is_animated(self):
         return self.animated
@@ -273,25 +343,51 @@ class BlingPatternBase(object):
         raise
     def clear(self):
         self.animation = None
-    
+        self.period = None
+        self.cache_key = None
+
+    def set_period(self, num_frames, *params):
+        #
+        # called by the setup of a periodic pattern, whose animation repeats itself every
+        # num_frames frames. As the frames only depend on the layout and on params, one period
+        # is rendered once and then played back from the frame cache of the bling manager
+        #
+        if num_frames is None or num_frames < 1:
+            self.period = None
+            self.cache_key = None
+            return
+        self.period = num_frames
+        self.cache_key = (self.name, self.layout.numLEDs) + params
+
+    def use_frame_cache(self):
+        cache = getattr(self.bling, 'frame_cache', None)
+        if cache is None or self.period is None:
+            return
+        frames = cache.get(self.cache_key)
+        if frames is None:
+            frames = render_period(self.animation, self.period)
+            if frames is None:
+                logger.debug( '%s pattern is not periodic over %d frames, not cached' % (self.name, self.period) )
+                return
+            cache.put(self.cache_key, frames)
+        self.animation = FramePlayback(self.layout, frames)
+
     def run(self):
+        if self.animation is None:
+            logger.error( 'Animation is NOT Setup' )
+            raise
+
         if self.animated is True:
-            if self.animation is None:
-                logger.error( 'Animation is NOT Setup' )
-                raise
-            
-            #run the animation
-            self.animation.run(fps=self.fps, threaded=True)
-        else:
-            # no animation, just update the LEDs
-            self.layout.update()
+            # replace a periodic animation by the playback of its cached frames
+            self.use_frame_cache()
+
+        # hand the animation to the render thread of the bling manager, which switches to it at
+        # the next frame boundary. A pattern that isn't animated is rendered once
+        self.bling.renderer.play(self.animation, self.fps if self.animated else 0)
 
     def stop(self):
-        if self.animation is not None:
-            #self.animation.join(1)
-            self.animation.stop()
-        self.layout.all_off()
-        self.layout.update()
+        # all LEDs off from the next frame
+        self.bling.renderer.play(None)
 
     def get_animation(self):
         if self.animation is None:
@@ -327,7 +423,7 @@ class SolidPattern(BlingPatternBase):
     def setup(self, layout, color_str, speed_str='MEDIUM', min_led=0, max_led=-1, segment_ctrl=None):
         self.layout = layout
         color = bling_colors.get_first_color(color_str)
-        self.layout.fill(color, start=min_led, end=max_led)
+        self.animation = SolidFill(layout, color, start=min_led, end=max_led)
 
 #
 # Class that implements the blinking pattern. This class uses the PartyMode animation, slowing
@@ -343,6 +439,8 @@ class BlinkingPattern(BlingPatternBase):
         self.set_fps(speed_str)
         colors = bling_colors.get_colors(color_str)
         self.animation = PartyMode.PartyMode(layout, colors=colors, start=min_led, end=max_led)
+        # each color is shown for one frame, followed by a frame with the LEDs off
+        self.set_period(2 * len(self.animation.palette), color_str, min_led, max_led)
 
         
 class AlternatesPattern(BlingPatternBase):
@@ -357,6 +455,7 @@ class AlternatesPattern(BlingPatternBase):
         if len(colors) < 2:
             colors.extend(bling_colors.get_colors('YELLOW'))
         self.animation = Alternates.Alternates(layout, max_led=max_led, color1=colors[0],color2=colors[1])
+        self.set_period(2, color_str, max_led)
         
 class ColorChasePattern(BlingPatternBase):
     def __init__(self, bling_mgr):
@@ -372,8 +471,11 @@ class ColorChasePattern(BlingPatternBase):
             segment_size = self.bling.get_segment_size()
             self.animation = SegmentColorChase(layout, num_segments=num_segments, segment_size=segment_size,
                                               color=color, width=DEFAULT_WIDTH, start=min_led, end=max_led)
+            period = segment_size - self.animation._start
         else:
             self.animation = ColorChase.ColorChase(layout, color=color, width=DEFAULT_WIDTH, start=min_led, end=max_led)
+            period = self.animation._end - self.animation._start
+        self.set_period(period, color_str, min_led, max_led, segment_ctrl)
 
 class ColorFadePattern(BlingPatternBase):
     def __init__(self, bling_mgr):
@@ -448,6 +550,8 @@ class ScannerPattern(BlingPatternBase):
             segment_size = self.bling.get_num_leds()
         self.animation = SegmentLarsonScanner(layout, num_segments=num_segments, segment_size=segment_size, 
                                               color=color, start=min_led, end=max_led)
+        # the scanner moves up the segment and back down again
+        self.set_period(max(2, 2 * (segment_size - 1 - self.animation._start)), color_str, min_led, max_led, segment_ctrl)
         
 class RainbowScannerPattern(BlingPatternBase):
     def __init__(self, bling_mgr):
@@ -518,7 +622,7 @@ class RainbowCyclePattern(BlingPatternBase):
     def setup(self, layout, color_str, speed_str='MEDIUM', min_led=0, max_led=-1, segment_ctrl=None):
         self.layout = layout
         self.set_fps(speed_str)
-        self.animation = Rainbows.RainbowCycle(layout, start=min_led, end=max_led)
+        self.animation = FrameRainbowCycle(layout, start=min_led, end=max_led)
         
 class LinearRainbowPattern(BlingPatternBase):
     def __init__(self, bling_mgr):
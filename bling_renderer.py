@@ -0,0 +1,172 @@
+import threading
+import time
+
+import numpy as np
+
+from bling_framebuffer import FrameDiff, write_frame
+from logger import logger
+
+#
+# BlingRenderer owns the single long-lived thread that renders the bling animations and pushes
+# the frames to the strip. Patterns don't run their own animation threads: play() hands the
+# animation of a new pattern to the renderer, which switches to it at the next frame boundary,
+# so the strip never shows a blank or half drawn frame in between two patterns.
+#
+# Frames are paced by a deadline on the monotonic clock, advanced by one frame period at a time
+# at the frame rate of the pattern. If rendering falls behind, the deadline is moved to the next
+# period rather than rendering a burst of frames to catch up. An animation with a frame rate of
+# 0 is static: its frame is rendered once and the thread then sleeps until the next switch.
+#
+# With a fade_time, a switch cross-fades from the frame shown at the time of the switch to the
+# new animation. For the duration of the fade, the old animation (if it is still animated) and
+# the new one each render into a scratch copy of the layout, and the two frames are blended into
+# the layout in the same frame pass. The new animation then takes over the layout itself.
+#
+# A frame that is identical to the last one sent to the strip, e.g. when an animation only
+# changes the LEDs every few frames, isn't pushed to the driver again, see FrameDiff.
+#
+class BlingRenderer(object):
+    def __init__(self, layout, fade_time=0.0, fade_fps=50):
+        self.layout = layout
+        self.fade_time = fade_time
+        self.fade_fps = fade_fps
+
+        # switch requested by play(), picked up by the render thread at the next frame boundary
+        self.lock = threading.Lock()
+        self.pending = None
+        self.wakeup = threading.Event()
+        self.running = False
+        self.thread = None
+
+        # owned by the render thread
+        self.animation = None
+        self.fps = 0
+        self.fade = None
+        self.frame_diff = FrameDiff()
+
+    def play(self, animation, fps=0):
+        # switch to the animation (or to all LEDs off for None) at the next frame boundary
+        with self.lock:
+            self.pending = (animation, fps)
+        if self.thread is None:
+            self.start()
+        self.wakeup.set()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='bling-render', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        # stop the thread once any pending switch has been rendered
+        if self.thread is None:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.thread.join( timeout )
+        self.thread = None
+
+    def frame_stats(self):
+        return self.frame_diff.stats()
+
+    def run(self):
+        deadline = None
+        while True:
+            # clear before looking at pending and running, so that a play() or stop() that
+            # comes in after this point always cuts the wait below short
+            self.wakeup.clear()
+            with self.lock:
+                pending, self.pending = self.pending, None
+            if pending is not None:
+                self.switch( *pending )
+                deadline = time.monotonic()
+            elif not self.running:
+                return
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                try:
+                    period = self.render_frame()
+                except Exception as err:
+                    logger.error( 'Bling animation failed: %s' % err )
+                    self.animation = None
+                    self.fade = None
+                    period = None
+
+                if period is None:
+                    deadline = None
+                else:
+                    deadline += period
+                    if deadline <= now:
+                        deadline = now + period
+
+            if deadline is None:
+                if not self.running:
+                    continue
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait( max(0.0, deadline - time.monotonic()) )
+
+    def switch(self, animation, fps):
+        old_animation = self.animation if self.fade is None and self.fps else None
+        self.animation = animation
+        self.fps = fps
+
+        num_frames = int( self.fade_time * (fps or self.fade_fps) )
+        if num_frames > 0:
+            # the old animation carries on from the frame on the strip, the new one starts from
+            # all LEDs off, each on its own copy of the layout
+            old_layout = self.layout.clone()
+            if old_animation is not None:
+                old_animation.layout = old_layout
+            new_layout = self.layout.clone()
+            new_layout.all_off()
+            if animation is not None:
+                animation.layout = new_layout
+                animation.pre_run()
+            self.fade = [ old_animation, old_layout, new_layout, 0, num_frames ]
+        else:
+            self.fade = None
+            self.layout.all_off()
+            if animation is not None:
+                animation.layout = self.layout
+                animation.pre_run()
+
+    def render_frame(self):
+        #
+        # render and push one frame, returning the time until the next one is due or None if
+        # the frame won't change until the next switch
+        #
+        if self.fade is not None:
+            self.render_fade()
+        elif self.animation is not None:
+            self.animation.step()
+        if self.frame_diff.changed( self.layout.color_list, self.layout.brightness ):
+            self.layout.push_to_driver()
+
+        if self.fade is not None:
+            return 1.0 / (self.fps or self.fade_fps)
+        if self.animation is not None and self.fps:
+            return 1.0 / self.fps
+        return None
+
+    def render_fade(self):
+        old_animation, old_layout, new_layout, frame, num_frames = self.fade
+        if old_animation is not None:
+            old_animation.step()
+        if self.animation is not None and (self.fps or frame == 0):
+            self.animation.step()
+
+        frame += 1
+        level = frame / num_frames
+        blended = np.asarray( old_layout.color_list, dtype=np.float64 ) * (1.0 - level) + \
+                  np.asarray( new_layout.color_list, dtype=np.float64 ) * level
+        write_frame( self.layout, blended.astype(np.uint8) )
+        self.fade[3] = frame
+
+        if frame >= num_frames:
+            # the new animation takes over the layout from here on
+            self.layout.color_list[:] = new_layout.color_list
+            if self.animation is not None:
+                self.animation.layout = self.layout
+            self.fade = None
@@ -0,0 +1,54 @@
+import time
+
+#
+# PublishCoalescer collects the axis values reported by the gamepad and publishes only the
+# latest value of each topic, all together, instead of publishing every single input event.
+#
+# Values are gathered until the end of an input frame (the EV_SYN event that follows a report
+# from the gamepad). At that point the batch is flushed if at least tick seconds have passed
+# since the previous flush, otherwise it is held until the tick expires. The owner of the
+# coalescer is expected to wait no longer than timeout() for further input before calling
+# flush(), so a held value is never delayed by more than one tick. With a tick of 0, every
+# frame is flushed as soon as it completes.
+#
+# The optional flush_callback is invoked after each batch, e.g. to flush the network tables
+# connection so that the batch goes out in a single update.
+#
+class PublishCoalescer(object):
+    def __init__(self, publishers, tick=0.0, flush_callback=None):
+        self.publishers = publishers
+        self.tick = tick
+        self.flush_callback = flush_callback
+        self.pending = {}
+        self.last_flush = 0.0
+
+    def set(self, name, value):
+        self.pending[name] = value
+
+    def frame_done(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.pending and now - self.last_flush >= self.tick:
+            self.flush(now)
+
+    def timeout(self, now=None):
+        # how long the caller may wait before the pending values must be flushed, or None if
+        # there is nothing pending
+        if not self.pending:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max( 0.0, self.last_flush + self.tick - now )
+
+    def flush(self, now=None):
+        if not self.pending:
+            return
+        for name, value in self.pending.items():
+            publisher = self.publishers.get(name, None)
+            if publisher:
+                publisher.set( value )
+        self.pending.clear()
+        self.last_flush = time.monotonic() if now is None else now
+
+        if self.flush_callback:
+            self.flush_callback()
@@ -0,0 +1,231 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+from evdev import InputDevice, list_devices
+
+from joystick import JoystickFrame
+from logger import logger
+
+#
+# Minimal inotify binding using the C library through ctypes, enough to be told when device
+# nodes are added to or removed from a directory without polling it.
+#
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL( ctypes.util.find_library('c') or 'libc.so.6', use_errno=True )
+        self.fd = self.libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError( error, os.strerror(error) )
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch( self.fd, os.fsencode(path), ctypes.c_uint32(mask) )
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError( error, os.strerror(error), path )
+        return wd
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        # return the pending (mask, name) events without blocking
+        events = []
+        while True:
+            try:
+                data = os.read( self.fd, 4096 )
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from( data, offset )
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset+name_len].rstrip(b'\0').decode()
+                offset += name_len
+                events.append( (mask, name) )
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close( self.fd )
+            self.fd = -1
+
+#
+# DeviceManager binds the supported gamepads to a fixed set of slots, one Joystick decoder per
+# slot, and keeps them bound as gamepads are unplugged and plugged back in. The input device
+# directory is watched with inotify, so a new device node is probed as soon as it appears (or
+# when udev changes its permissions) and a removed gamepad releases its slot. A gamepad that
+# comes back on the same USB port returns to the slot it had before, so that it keeps driving
+# the same robot.
+#
+# Listeners are called with (slot, device) whenever a slot is bound, and with (slot, None) when
+# it is released, e.g. to stop the robot that a disconnected gamepad was driving.
+#
+class DeviceManager(object):
+    def __init__(self, joysticks, supported_devices, input_dir='/dev/input', hotplug=True):
+        self.joysticks = joysticks
+        self.supported_devices = supported_devices
+        self.input_dir = input_dir
+        self.hotplug = hotplug
+        self.inotify = None
+        self.listeners = []
+
+        self.frames = [ JoystickFrame() for _ in joysticks ]
+        self.slot_phys = [ None ] * len(joysticks)
+
+    def start(self):
+        # watch the directory before scanning it, so that no device can slip through in between
+        if self.hotplug:
+            try:
+                self.inotify = Inotify()
+                self.inotify.add_watch( self.input_dir, IN_CREATE | IN_ATTRIB | IN_DELETE )
+            except OSError as error:
+                logger.error( 'Unable to watch %s for gamepads, hot-plug disabled: %s' % (self.input_dir, error) )
+                self.close()
+
+        for slot, joystick in enumerate(self.joysticks):
+            if joystick.gamepad:
+                self.slot_phys[slot] = joystick.gamepad.phys
+        for path in list_devices( self.input_dir ):
+            self.probe( path )
+
+        if not self.bound_slots():
+            logger.info( 'No gamepad connected' )
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def bound_slots(self):
+        return [ slot for slot, joystick in enumerate(self.joysticks) if joystick.gamepad ]
+
+    def slot_of(self, path):
+        for slot, joystick in enumerate(self.joysticks):
+            if joystick.gamepad and joystick.gamepad.path == path:
+                return slot
+        return None
+
+    def free_slot(self, phys):
+        free = [ slot for slot, joystick in enumerate(self.joysticks) if not joystick.gamepad ]
+        for slot in free:
+            if phys and self.slot_phys[slot] == phys:
+                return slot
+        for slot in free:
+            if self.slot_phys[slot] is None:
+                return slot
+        return free[0] if free else None
+
+    def probe(self, path):
+        if self.slot_of(path) is not None or len(self.bound_slots()) == len(self.joysticks):
+            return
+
+        try:
+            device = InputDevice( path )
+        except OSError:
+            # not accessible (yet), a permission change by udev will trigger another probe
+            return
+
+        if device.name not in self.supported_devices:
+            device.close()
+            return
+
+        self.bind( self.free_slot(device.phys), device )
+
+    def bind(self, slot, device):
+        logger.info( 'Gamepad %d connected: %s' % (slot, device) )
+        self.joysticks[slot].attach( device )
+        self.frames[slot].clear()
+        self.slot_phys[slot] = device.phys
+        for listener in self.listeners:
+            listener( slot, device )
+
+    def release(self, slot):
+        if not self.joysticks[slot].gamepad:
+            return
+        logger.info( 'Gamepad %d disconnected' % slot )
+        self.joysticks[slot].detach()
+        for listener in self.listeners:
+            listener( slot, None )
+
+    def process_events(self):
+        for mask, name in self.inotify.read_events():
+            if not name.startswith('event'):
+                continue
+            path = os.path.join( self.input_dir, name )
+            if mask & IN_DELETE:
+                slot = self.slot_of( path )
+                if slot is not None:
+                    self.release( slot )
+            else:
+                self.probe( path )
+
+    def pending_frames(self, slot):
+        #
+        # yield the complete frames pending on the gamepad of a slot, releasing the slot if the
+        # device has gone away
+        #
+        try:
+            yield from self.joysticks[slot].pending_frames( self.frames[slot] )
+        except OSError as error:
+            if error.errno != errno.ENODEV:
+                logger.error( 'Gamepad %d read failed: %s' % (slot, error) )
+            self.release( slot )
+
+    def read_frames(self, timeout=None, readers=None, writers=None):
+        #
+        # threaded input pump over all of the slots, yielding (slot, frame) for every complete
+        # frame and (None, None) when timeout (seconds, or a function returning it) expires.
+        # readers and writers optionally map other files, e.g. sockets, to a function to call
+        # when the file is readable or writable. Either may also be a function returning the
+        # map, for files that come and go
+        #
+        while True:
+            other_readers = readers() if callable(readers) else readers
+            other_writers = writers() if callable(writers) else writers
+            waiting = [ self.joysticks[slot] for slot in self.bound_slots() ]
+            if self.inotify:
+                waiting.append( self )
+            if other_readers:
+                waiting.extend( other_readers )
+            wait = timeout() if callable(timeout) else timeout
+            if not waiting and not other_writers and wait is None:
+                # nothing could ever wake us up, e.g. no gamepad at startup without hotplug
+                logger.error( 'No gamepads or other inputs to wait for' )
+                return
+            readable, writable, _ = select.select( waiting, other_writers or [], [], wait )
+            if not readable and not writable:
+                yield None, None
+                continue
+
+            for writer in writable:
+                other_writers[writer]()
+
+            for reader in readable:
+                if reader is self:
+                    self.process_events()
+                    continue
+                if other_readers and reader in other_readers:
+                    other_readers[reader]()
+                    continue
+                slot = self.joysticks.index( reader )
+                if reader.gamepad:
+                    for frame in self.pending_frames( slot ):
+                        yield slot, frame
@@ -16,8 +16,15 @@ import bling_patterns
 from config import read_config
 from logger import logger
 from bling_menu import bling_menu
-from joystick import Joystick
+from coalescer import PublishCoalescer
+from device_manager import DeviceManager
+from joystick import Joystick, EVENT_BUTTON, EVENT_AXIS
 from lidar import Lidar
+from lidar_filters import create_filter
+from lidar_replay import ReplayLidar
+from lidar_tracker import TargetTracker
+from runtime import AsyncRuntime
+from steering import bucket_turning_speed, bucket_moving_speed, signed_angle, speed_changed, create_pid
 
 class LidarStates(Enum):
     INITIAL = auto()
@@ -32,22 +39,30 @@ class FrcController(Joystick):
     def __init__(self, path=None, team_number=9999):
         super().__init__(path)
 
-        signal.signal(signal.SIGINT, self.shutdown)
-        signal.signal(signal.SIGTERM, self.shutdown)
-
         self.inst = ntcore.NetworkTableInstance.getDefault()
         self.inst.startClient4('Test client')
         self.inst.setServerTeam(team_number) 
 
-        self.table = self.inst.getTable("RobotRemoteControl")
-        self.publishers = {}
-        for button in list(self.BUTTONS.values()):
-            self.publishers[button['name']] = self.table.getIntegerTopic(button['name']).publish()
-        for axis in list(self.AXIS_TYPES.values()):
-            self.publishers[axis['name']] = self.table.getDoubleTopic(axis['name']).publish()
+        self.table_name = "RobotRemoteControl"
+        self.table = self.inst.getTable(self.table_name)
+        self.publishers = self.create_publishers( self.table )
+
+        # axis updates are coalesced and published once per input frame, see configure_publishing()
+        self.flush_updates = False
+        self.publish_tick = 0.0
+        self.coalescer = PublishCoalescer(self.publishers)
+
+        # the first gamepad slot is driven by the controller itself and publishes to the table
+        # above, further slots are added by configure_gamepads()
+        self.slot_joysticks = [ self ]
+        self.slot_publishers = [ self.publishers ]
+        self.slot_coalescers = [ self.coalescer ]
+        self.hotplug = True
 
         self.lidar = None
         self.lidar_state = LidarStates.INITIAL
+        # the asyncio runtime can't block its loop waiting for the scan thread to exit
+        self.lidar_blocking = True
         
         self.bling = None
 
@@ -56,28 +71,186 @@ class FrcController(Joystick):
         self.curr_moving_speed = 0.0
         self.moving_noupdates = 0
 
+        # steering defaults to the bucket speed tables, see configure_steering()
+        self.align_pid = None
+        self.follow_pid = None
+        self.publish_threshold = 0.0
+
+    def create_publishers(self, table):
+        publishers = {}
+        for button in list(self.BUTTONS.values()):
+            publishers[button['name']] = table.getIntegerTopic(button['name']).publish()
+        for axis in list(self.AXIS_TYPES.values()):
+            publishers[axis['name']] = table.getDoubleTopic(axis['name']).publish()
+        return publishers
+
+    def create_coalescer(self, publishers):
+        flush_callback = None
+        if self.flush_updates:
+            flush_callback = self.inst.flush
+        return PublishCoalescer( publishers, tick=self.publish_tick, flush_callback=flush_callback )
+
+    def configure_publishing(self, publish_config):
+        #
+        # configure how the joystick axis updates are published: tick is the minimum time
+        # between two batches of axis updates (e.g. 0.01 for 100 Hz), and flush requests that
+        # each batch, and each button change, is sent to the robot right away
+        #
+        self.flush_updates = publish_config.get('flush', False)
+        self.publish_tick = publish_config.get('tick', 0.0)
+        self.slot_coalescers = [ self.create_coalescer(publishers) for publishers in self.slot_publishers ]
+        self.coalescer = self.slot_coalescers[0]
+
+    def configure_gamepads(self, gamepad_config):
+        #
+        # configure the gamepad slots, listing the table that each gamepad publishes to, e.g.
+        # { "tables": [ "RobotRemoteControl", "RobotRemoteControl2" ] } to drive a second robot
+        # from a second gamepad. hotplug enables watching for gamepads being connected and
+        # disconnected while running
+        #
+        self.hotplug = gamepad_config.get('hotplug', True)
+        tables = gamepad_config.get('tables', [])
+        if tables and tables[0] != self.table_name:
+            self.table_name = tables[0]
+            self.table = self.inst.getTable(self.table_name)
+            self.publishers = self.create_publishers( self.table )
+            self.coalescer = self.create_coalescer( self.publishers )
+            self.slot_publishers[0] = self.publishers
+            self.slot_coalescers[0] = self.coalescer
+
+        for table_name in tables[1:]:
+            joystick = Joystick( probe=False )
+            joystick.configure_axis_filters( self.filter_config )
+            publishers = self.create_publishers( self.inst.getTable(table_name) )
+            self.slot_joysticks.append( joystick )
+            self.slot_publishers.append( publishers )
+            self.slot_coalescers.append( self.create_coalescer(publishers) )
+
+    def create_device_manager(self):
+        manager = DeviceManager( self.slot_joysticks, self.SUPPORTED_DEVICES, hotplug=self.hotplug )
+        manager.listeners.append( self.gamepad_changed )
+        manager.start()
+        return manager
+
+    def gamepad_changed(self, slot, device):
+        #
+        # when a gamepad is disconnected, release all of its buttons and center all of its axes
+        # so that the robot it was driving doesn't keep moving
+        #
+        if device:
+            return
+        publishers = self.slot_publishers[slot]
+        coalescer = self.slot_coalescers[slot]
+        coalescer.pending.clear()
+        for button in self.BUTTONS.values():
+            publishers[button['name']].set( 0 )
+        for axis in self.AXIS_TYPES.values():
+            publishers[axis['name']].set( 0.0 )
+        self.inst.flush()
+
+    def flush_timeout(self):
+        # the longest time the input pump may wait before a held axis value must be published
+        timeouts = [ timeout for timeout in (c.timeout() for c in self.slot_coalescers) if timeout is not None ]
+        return min(timeouts) if timeouts else None
+
+    def configure_steering(self, steering_config):
+        #
+        # set up the PID controllers for the align and follow steering if the PID steering
+        # mode is configured. speed updates are published only when they change by at least
+        # publish_threshold, to avoid flooding the network tables with tiny adjustments
+        #
+        if steering_config.get('mode', 'bucket').lower() == 'pid':
+            self.align_pid = create_pid( steering_config.get('align', {}) )
+            self.follow_pid = create_pid( steering_config.get('follow', {}) )
+            self.publish_threshold = steering_config.get('publish_threshold', 0.05)
+            logger.info( 'Using PID steering' )
+
+    def install_signal_handlers(self):
+        # for the threaded controllers only, AsyncRuntime handles the signals on its own loop
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+
     def shutdown( self, *args ):
+        self.cleanup()
+
+        sys.exit(0)
+
+    def cleanup(self):
         if self.lidar:
             logger.info( 'Terminating LIDAR Session' )
             self.set_lidar_state( LidarStates.TERMINATING)
             self.lidar.cancel()
 
             logger.info( 'Shutting down LIDAR' )
-            controller.lidar.terminate()
+            self.lidar.terminate()
 
         time.sleep(2)
         self.set_lidar_state( LidarStates.TERMINATED )
+        if self.bling:
+            self.bling.close()
         logger.info( 'Shutdown complete.' )
 
-        sys.exit(0)
+    def process_frame(self, frame, slot=0):
+        #
+        # buttons are published immediately, while the axis values of the frame are handed to
+        # the coalescer and published together once the frame is complete
+        #
+        publishers = self.slot_publishers[slot]
+        coalescer = self.slot_coalescers[slot]
+        for decoded_event in frame:
+            if decoded_event.kind == EVENT_BUTTON:
+                publisher = publishers.get(decoded_event.name, None)
+                if publisher:
+                    publisher.set( decoded_event.value )
+                    if self.flush_updates:
+                        self.inst.flush()
+            elif decoded_event.kind == EVENT_AXIS:
+                if decoded_event.name:
+                    coalescer.set( decoded_event.name, decoded_event.value )
+
+        coalescer.frame_done()
 
     def joystick_control(self):
-        for event in self.gamepad.read_loop():
-            decoded_event = self.decode_event( event )
-            if decoded_event['type'] == 'BUTTON' or decoded_event['type'] == 'AXIS':
-                publisher = self.publishers.get(decoded_event['name'], None)
-                if publisher:
-                    publisher.set( decoded_event['value'] )
+        #
+        # input is processed a frame (one complete report from a gamepad) at a time. The wait
+        # for input is bounded by the coalescers so that held axis values go out within one
+        # publish tick.
+        #
+        manager = self.create_device_manager()
+        try:
+            for slot, frame in manager.read_frames( self.flush_timeout ):
+                if frame is None:
+                    for coalescer in self.slot_coalescers:
+                        coalescer.flush()
+                else:
+                    self.process_frame( frame, slot )
+        finally:
+            manager.close()
+
+    async def joystick_control_async(self, runtime):
+        #
+        # asyncio version of joystick_control, where held axis values are flushed by a timer
+        # on the event loop instead of bounding the wait for input
+        #
+        flush_timers = {}
+
+        def flush(slot):
+            del flush_timers[slot]
+            self.slot_coalescers[slot].flush()
+
+        def process_frame(slot, frame):
+            self.process_frame( frame, slot )
+            timeout = self.slot_coalescers[slot].timeout()
+            if timeout is not None and slot not in flush_timers:
+                flush_timers[slot] = runtime.loop.call_later( timeout, flush, slot )
+
+        manager = self.create_device_manager()
+        try:
+            await runtime.pump_gamepads( manager, process_frame )
+        finally:
+            for timer in flush_timers.values():
+                timer.cancel()
+            manager.close()
 
     def set_lidar_state(self,new_state):
         curr_state = self.lidar_state
@@ -88,7 +261,7 @@ class FrcController(Joystick):
                 self.set_bling('Pattern=Scanner,Color=RED,Speed=MEDIUM')
             elif new_state == LidarStates.ACQUIRED:
                 if self.follow_distance != 0:
-                    self.lidar.cancel()
+                    self.lidar.cancel( wait=self.lidar_blocking )
                 self.set_bling('Pattern=Solid,Color=GREEN')
             elif new_state == LidarStates.STOPPED:
                 self.set_bling('Pattern=Solid,Color=GREEN')
@@ -102,8 +275,9 @@ class FrcController(Joystick):
         self.lidar_state = new_state
 
     def set_bling( self, cmd_string ):
+        # handed to the bling worker, the LED updates never hold up the control loop
         if self.bling:
-            self.bling.process_cmd(cmd_string)
+            self.bling.submit_cmd(cmd_string)
 
     def lidar_align(self, scan_data, precision_factor=1.0):
         #
@@ -118,29 +292,21 @@ class FrcController(Joystick):
             if publisher:
                 angle = scan_data['angle']
                 if angle < 5 or angle > 355:
-                    turning_speed = 0.0
-
                     # if the lidar is acquiring the target, then
                     # transition to the acquired state and wait 
                     # for further command
                     if self.lidar_state == LidarStates.ACQUIRING:
                         self.set_lidar_state( LidarStates.ACQUIRED )
-                        
-                elif angle < 20 or angle > 340:
-                    turning_speed = 0.2
-                elif angle < 90 or angle > 270:
-                    turning_speed = 0.4
+
+                if self.align_pid:
+                    turning_speed = self.align_pid.update( signed_angle(angle) )
                 else:
-                    turning_speed = 0.6
-                
-                # if the angle is greater than 180, then we will turn to the left
-                if angle > 180:
-                    turning_speed *= -1.0
+                    turning_speed = bucket_turning_speed( angle )
 
                 if self.lidar_state == LidarStates.FOLLOWING:
                     turning_speed *= precision_factor
 
-            if turning_speed != self.curr_turning_speed:
+            if speed_changed( turning_speed, self.curr_turning_speed, self.publish_threshold ):
                 self.curr_turning_speed = turning_speed
                 publisher.set( turning_speed )
                 #logger.debug( 'Setting turning speed to %0.1f' % turning_speed )
@@ -148,6 +314,8 @@ class FrcController(Joystick):
             self.turning_noupdates += 1
 
         if self.turning_noupdates == 5:
+            if self.align_pid:
+                self.align_pid.reset()
             if self.curr_turning_speed != 0.0:
                 self.curr_turning_speed = 0.0
                 publisher.set( 0.0 )
@@ -175,20 +343,18 @@ class FrcController(Joystick):
                 if distance <= self.follow_distance: 
                     moving_speed = 0.0
                     self.set_lidar_state( LidarStates.STOPPED )
-                elif distance < self.follow_distance + 6:
-                    self.set_lidar_state( LidarStates.FOLLOWING )
-                elif distance < self.follow_distance + 12:
-                    moving_speed = 0.2
-                elif distance < self.follow_distance + 36:
-                    moving_speed = 0.3
-                elif distance < self.follow_distance + 48:
-                    moving_speed = 0.4
+                    if self.follow_pid:
+                        self.follow_pid.reset()
                 else:
-                    moving_speed = 0.6
-                
-                moving_speed *= -1.0
+                    if distance < self.follow_distance + 6:
+                        self.set_lidar_state( LidarStates.FOLLOWING )
 
-                if moving_speed != self.curr_moving_speed:
+                    if self.follow_pid:
+                        moving_speed = -self.follow_pid.update( distance - self.follow_distance )
+                    else:
+                        moving_speed = bucket_moving_speed( distance, self.follow_distance )
+
+                if speed_changed( moving_speed, self.curr_moving_speed, self.publish_threshold ):
                     self.curr_moving_speed = moving_speed
                     publisher.set( moving_speed )
                     #logger.debug( 'Setting moving speed to %0.1f' % moving_speed )
@@ -197,6 +363,8 @@ class FrcController(Joystick):
             self.moving_noupdates += 1
 
         if self.moving_noupdates >= 5:
+            if self.follow_pid:
+                self.follow_pid.reset()
             if self.curr_moving_speed != 0.0:
                 self.curr_moving_speed = 0.0
                 publisher.set( 0.0 )
@@ -210,23 +378,78 @@ class FrcController(Joystick):
         self.publishers.get('RightJoystickX', None).set(0.0)
 
 
-    def lidar_control(self, port='/dev/ttyUSB0', capture_distance=48, capture_zone='0-45,315-359', follow_distance=0):
+    def prepare_lidar(self, port='/dev/ttyUSB0', capture_distance=48, capture_zone='0-45,315-359', follow_distance=0,
+                      tracking=None, replay=None, record=None):
+        #
+        # open the LIDAR (or the scan log to replay) and set up the capture zone, returning the
+        # target tracker if tracking is enabled
+        #
         if self.lidar == None:
-            self.lidar = Lidar(port)
+            if replay:
+                # drive the controller from a recorded scan log instead of the LIDAR device
+                self.lidar = ReplayLidar(replay)
+            else:
+                self.lidar = Lidar(port)
+
+        if record:
+            self.lidar.start_recording(record)
+
+        # the same tracker is used for the align and follow phases so that the robot keeps
+        # following the object that it aligned to
+        tracker = None
+        if tracking and tracking.get('enabled', False) == True:
+            tracker = TargetTracker( gate=tracking.get('gate', 18.0),
+                                     max_misses=tracking.get('max_misses', 3),
+                                     angle_gap=tracking.get('angle_gap', 3.0),
+                                     range_gap=tracking.get('range_gap', 6.0) )
 
         self.capture_distance = capture_distance
         self.follow_distance = follow_distance
         self.lidar.build_ranges(capture_zone)
+        return tracker
+
+    def finish_lidar(self):
+        self.lidar_halt()
+        self.lidar.stop_recording()
+        self.set_lidar_state( LidarStates.TERMINATING )
+
+    def lidar_control(self, port='/dev/ttyUSB0', capture_distance=48, capture_zone='0-45,315-359', follow_distance=0,
+                      streaming=False, event_driven=False, max_period=0.05, tracking=None, replay=None, record=None,
+                      sample_filter=None):
+        tracker = self.prepare_lidar( port, capture_distance, capture_zone, follow_distance, tracking, replay, record )
 
         self.set_lidar_state( LidarStates.ACQUIRING )
-        self.lidar.closest_in_range(ranges=None, min_distance=capture_distance, sample_interval=0.05, callback=self.lidar_align)
+        self.lidar.closest_in_range(ranges=None, min_distance=capture_distance, sample_interval=0.05, callback=self.lidar_align,
+                                    streaming=streaming, event_driven=event_driven, max_period=max_period, tracker=tracker,
+                                    sample_filter=create_filter(sample_filter))
 
         if self.follow_distance != 0:
             self.set_lidar_state( LidarStates.STOPPED )
-            self.lidar.closest_in_range(ranges=None, min_distance=self.lidar.MAX_DISTANCE, sample_interval=0.05, callback=self.lidar_follow)
+            self.lidar.closest_in_range(ranges=None, min_distance=self.lidar.MAX_DISTANCE, sample_interval=0.05, callback=self.lidar_follow,
+                                        streaming=streaming, event_driven=event_driven, max_period=max_period, tracker=tracker,
+                                        sample_filter=create_filter(sample_filter))
 
-        self.lidar_halt()
-        self.set_lidar_state( LidarStates.TERMINATING )
+        self.finish_lidar()
+
+    async def lidar_control_async(self, runtime, port='/dev/ttyUSB0', capture_distance=48, capture_zone='0-45,315-359',
+                                  follow_distance=0, streaming=False, event_driven=False, max_period=0.05, tracking=None,
+                                  replay=None, record=None, sample_filter=None):
+        # asyncio version of lidar_control, taking the LIDAR samples on the event loop
+        tracker = self.prepare_lidar( port, capture_distance, capture_zone, follow_distance, tracking, replay, record )
+        self.lidar_blocking = False
+
+        self.set_lidar_state( LidarStates.ACQUIRING )
+        await runtime.pump_lidar( self.lidar, self.lidar_align, min_distance=capture_distance, sample_interval=0.05,
+                                  streaming=streaming, event_driven=event_driven, max_period=max_period, tracker=tracker,
+                                  sample_filter=create_filter(sample_filter) )
+
+        if self.follow_distance != 0:
+            self.set_lidar_state( LidarStates.STOPPED )
+            await runtime.pump_lidar( self.lidar, self.lidar_follow, min_distance=self.lidar.MAX_DISTANCE, sample_interval=0.05,
+                                      streaming=streaming, event_driven=event_driven, max_period=max_period, tracker=tracker,
+                                      sample_filter=create_filter(sample_filter) )
+
+        self.finish_lidar()
 
 if __name__ == '__main__':
 
@@ -245,24 +468,53 @@ if __name__ == '__main__':
         logger.setLevel(logging.DEBUG)
 
     controller = FrcController(team_number=config.get('team', 9999))
+    controller.configure_steering( config.get('steering', {}) )
+    controller.configure_publishing( config.get('publish', {}) )
+    controller.configure_axis_filters( config.get('axis_filters', None) )
+    controller.configure_gamepads( config.get('gamepads', {}) )
 
     try:
         bling_config = config.get('bling', None)
         if bling_config != None:
             controller.bling = Bling( num_leds=bling_config.get('leds',12),
                                       num_segments=bling_config.get('segments',1),
-                                      brightness=bling_config.get('brightness',100) )
-
-        if config['controller'] == 'joystick':
+                                      brightness=bling_config.get('brightness',100),
+                                      frame_cache_bytes=bling_config.get('frame_cache_bytes', 4*1024*1024),
+                                      fade_time=bling_config.get('fade_time', 0.0) )
+
+        lidar_config = config.get('lidar',None)
+        lidar_args = {}
+        if lidar_config:
+            lidar_args = dict( port=lidar_config.get('port', '/dev/ttyUSB0'),
+                               capture_zone=lidar_config.get('capture_zone', '0-60,300-359'),
+                               capture_distance=lidar_config.get('capture_distance', 30),
+                               follow_distance=lidar_config.get('follow_distance', 48),
+                               streaming=lidar_config.get('streaming', False),
+                               event_driven=lidar_config.get('event_driven', False),
+                               max_period=lidar_config.get('max_period', 0.05),
+                               tracking=lidar_config.get('tracking', None),
+                               replay=lidar_config.get('replay', None),
+                               record=lidar_config.get('record', None),
+                               sample_filter=lidar_config.get('filter', None) )
+
+        if config.get('runtime', 'threaded') == 'asyncio' and config['controller'] in ('joystick', 'lidar'):
+            #
+            # run the controller on a single asyncio event loop, see runtime.py
+            #
+            runtime = AsyncRuntime()
+            if config['controller'] == 'joystick':
+                runtime.run( controller.joystick_control_async(runtime), cleanup=controller.cleanup )
+            elif lidar_config:
+                runtime.run( controller.lidar_control_async(runtime, **lidar_args), cleanup=controller.cleanup )
+        elif config['controller'] == 'joystick':
+            controller.install_signal_handlers()
             controller.joystick_control()
         elif config['controller'] == 'lidar':
-            lidar_config = config.get('lidar',None)
+            controller.install_signal_handlers()
             if lidar_config:
-                controller.lidar_control( port=lidar_config.get('port', '/dev/ttyUSB0'),
-                                          capture_zone=lidar_config.get('capture_zone', '0-60,300-359'),
-                                          capture_distance=lidar_config.get('capture_distance', 30),
-                                          follow_distance=lidar_config.get('follow_distance', 48) )
+                controller.lidar_control( **lidar_args )
         elif config['controller'] == 'bling':
+            controller.install_signal_handlers()
             bling_menu( controller.bling )
         else:
             logger.error( 'ERROR: No Controller Type Specified' )
@@ -270,4 +522,3 @@ if __name__ == '__main__':
 
     except KeyboardInterrupt:
         controller.shutdown();
-
@@ -2,8 +2,130 @@
 from evdev import InputDevice, categorize, ecodes, KeyEvent, list_devices
 
 import logging
+import select
 from logger import logger
 
+#
+# AxisFilter suppresses insignificant changes of a single joystick axis before they are
+# forwarded. Values inside the deadband (as a fraction of full scale) are reported as 0,
+# values are optionally quantized to multiples of quantize, and a value is only reported when
+# it differs from the last reported value by at least min_delta (a return to 0 is always
+# reported). The deadband is precomputed in raw device units so that the centre noise of an
+# idle stick is rejected with a single comparison.
+#
+class AxisFilter:
+    def __init__(self, axis_max, deadband=0.0, min_delta=0.0, quantize=0.0):
+        self.scale = 1.0 / axis_max
+        self.raw_deadband = deadband * axis_max
+        self.min_delta = min_delta
+        self.quantize = quantize
+        self.last_value = 0.0
+
+    def reset(self):
+        self.last_value = 0.0
+
+    def apply(self, raw_value):
+        # returns the filtered value, or None if the change should be suppressed
+        if -self.raw_deadband < raw_value < self.raw_deadband:
+            value = 0.0
+        else:
+            value = raw_value * self.scale
+            if self.quantize:
+                value = round( round(value / self.quantize) * self.quantize, 6 )
+
+        if value == self.last_value:
+            return None
+        # the values are rounded to 6 places, so round their difference too before comparing it
+        if value != 0.0 and round( abs(value - self.last_value), 6 ) < self.min_delta:
+            return None
+
+        self.last_value = value
+        return value
+
+#
+# Event kinds reported by Joystick.decode(). EVENT_TYPE_NAMES maps each kind back onto the
+# type strings used by the dictionary based decode_event() API.
+#
+EVENT_UNKNOWN = 0
+EVENT_SYN = 1
+EVENT_BUTTON = 2
+EVENT_AXIS = 3
+EVENT_FILTERED = 4
+
+EVENT_TYPE_NAMES = ( 'UNKNOWN', 'SYN', 'BUTTON', 'AXIS', 'FILTERED' )
+
+#
+# Entry in the decode dispatch table describing one (type, code) input. The scale converts
+# the raw axis value to the normalized -1.0 to 1.0 range.
+#
+class Control:
+    __slots__ = ( 'kind', 'name', 'scale', 'axis_filter' )
+
+    def __init__(self, kind, name='', scale=1):
+        self.kind = kind
+        self.name = name
+        self.scale = scale
+        self.axis_filter = None
+
+#
+# Decoded input event. Joystick.decode() fills in a reusable instance of this class rather
+# than allocating a new object for every event, so a consumer that needs to hold on to an
+# event beyond the next call to decode() has to pass in its own instance.
+#
+class JoystickEvent:
+    __slots__ = ( 'kind', 'name', 'code', 'value' )
+
+    def __init__(self):
+        self.kind = EVENT_UNKNOWN
+        self.name = ''
+        self.code = 0
+        self.value = 0
+
+    @property
+    def type(self):
+        return EVENT_TYPE_NAMES[self.kind]
+
+    @property
+    def rounded_value(self):
+        return round(self.value, 2)
+
+    def as_dict(self):
+        decoded_event = { 'type': EVENT_TYPE_NAMES[self.kind], 'name': self.name, 'value': self.value }
+        if self.name and (self.kind == EVENT_AXIS or self.kind == EVENT_FILTERED):
+            decoded_event['rounded_value'] = round(self.value, 2)
+        return decoded_event
+
+#
+# JoystickFrame holds the decoded events of one report from the gamepad, that is all of the
+# events up to and including the EV_SYN event that ends the report. The JoystickEvent objects
+# are pooled and refilled for each frame, so a frame is only valid until the next one is read.
+#
+class JoystickFrame:
+    __slots__ = ( 'events', 'count' )
+
+    def __init__(self):
+        self.events = []
+        self.count = 0
+
+    def next_event(self):
+        # hand out the next pooled event, growing the pool the first time a frame gets this long
+        if self.count == len(self.events):
+            self.events.append( JoystickEvent() )
+        event = self.events[self.count]
+        self.count += 1
+        return event
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        events = self.events
+        for i in range(self.count):
+            yield events[i]
+
 class Joystick:
     SUPPORTED_DEVICES = (
         "Logitech Gamepad F310"
@@ -38,53 +160,195 @@ class Joystick:
         17: { 'name': 'HatY', 'min': -1, 'max': 1 }
     }
 
-    def __init__(self, path=None):
+    # event type values are below 0x20 and event codes below 0x400, so the dispatch table is
+    # indexed by (type << DISPATCH_CODE_BITS) | code
+    DISPATCH_CODE_BITS = 10
+    DISPATCH_SIZE = 0x20 << DISPATCH_CODE_BITS
+
+    # the most events returned by a single batch read() of the device
+    READ_BATCH_SIZE = 64
+
+    def __init__(self, path=None, probe=True):
         self.gamepad = None
 
+        # per-axis filters, indexed by the axis event code, see configure_axis_filters()
+        self.axis_filters = {}
+        self.filter_config = None
+
+        self.build_dispatch_table()
+        self.decoded = JoystickEvent()
+
         if path:
             self.gamepad = InputDevice(path)
-        else:
-            devices = [InputDevice(path) for path in list_devices()]
-            for device in devices:
+        elif probe:
+            # bind to the first supported gamepad, closing each device that was opened only
+            # to read its name
+            for device_path in list_devices():
+                device = InputDevice(device_path)
                 if device.name in self.SUPPORTED_DEVICES:
                     logger.info( device )
-                    self.gamepad = InputDevice(device.path)
+                    self.gamepad = device
                     break
+                device.close()
 
-    def decode_event(self, event):
-        decoded_event = { 'type': 'UNKNOWN', 'name': '', 'value': event.value }
-
-        if event.type == ecodes.EV_SYN:
-            decoded_event['type'] = 'SYN'
-        elif event.type == ecodes.EV_KEY:
-            decoded_event['type'] = 'BUTTON'
-            button = self.BUTTONS.get(event.code, None)
-            if button:
-                decoded_event['name'] = button['name']
-                decoded_event['value'] = event.value
-        elif event.type == ecodes.EV_ABS:
-            decoded_event['type'] = 'AXIS'
-            axis = self.AXIS_TYPES.get(event.code, None)
-            if axis:
-                decoded_event['name'] = axis['name']
-                decoded_event['value'] = event.value / axis['max']
-                decoded_event['rounded_value'] = round((event.value / axis['max']), 2)
+    def fileno(self):
+        return self.gamepad.fileno()
 
-        return decoded_event
+    def attach(self, device):
+        # bind the joystick to a newly connected device, forgetting the axis values of the last one
+        self.gamepad = device
+        for axis_filter in self.axis_filters.values():
+            axis_filter.reset()
 
-    def read(self):
-        for event in self.gamepad.read_loop():
-            decoded_event = self.decode_event( event )
-            if decoded_event['type'] == 'SYN':
-                # ignore the SYN event types, not much to do with them
+    def detach(self):
+        if self.gamepad:
+            try:
+                self.gamepad.close()
+            except OSError:
+                # the device node is already gone
                 pass
-            elif decoded_event['type'] == 'BUTTON':
-                processed_state = self.BUTTON_STATES.get(decoded_event['value'], 'UNKNOWN')
-                logger.debug( 'Button Type: %s, Value: %s' % (decoded_event['name'], processed_state) )
-            elif decoded_event['type'] == 'AXIS':
-                logger.debug( 'Axis Type: %s, Value: %f' % (decoded_event['name'], decoded_event['value']) )
+            self.gamepad = None
+
+    def build_dispatch_table(self):
+        #
+        # precompute a dense table holding the Control for every possible (type, code) pair so
+        # that decoding an event, known or not, costs a single list lookup
+        #
+        unknown = Control(EVENT_UNKNOWN)
+        defaults = { ecodes.EV_SYN: Control(EVENT_SYN),
+                     ecodes.EV_KEY: Control(EVENT_BUTTON),
+                     ecodes.EV_ABS: Control(EVENT_AXIS) }
+
+        num_codes = 1 << self.DISPATCH_CODE_BITS
+        dispatch = []
+        for event_type in range(self.DISPATCH_SIZE // num_codes):
+            dispatch.extend( [defaults.get(event_type, unknown)] * num_codes )
+
+        self.axis_controls = {}
+        for code, button in self.BUTTONS.items():
+            dispatch[(ecodes.EV_KEY << self.DISPATCH_CODE_BITS) | code] = Control(EVENT_BUTTON, button['name'])
+        for code, axis in self.AXIS_TYPES.items():
+            control = Control(EVENT_AXIS, axis['name'], 1.0 / axis['max'])
+            self.axis_controls[code] = control
+            dispatch[(ecodes.EV_ABS << self.DISPATCH_CODE_BITS) | code] = control
+
+        self.dispatch = dispatch
+
+    def configure_axis_filters(self, filter_config):
+        #
+        # build the per-axis filters from the configuration. The 'default' section applies
+        # to every axis, and a section named after an axis (e.g. 'LeftTrigger') overrides
+        # the default settings for that axis
+        #
+        self.axis_filters = {}
+        self.filter_config = filter_config
+        for control in self.axis_controls.values():
+            control.axis_filter = None
+        if not filter_config:
+            return
+
+        default_config = filter_config.get('default', {})
+        for code, axis in self.AXIS_TYPES.items():
+            axis_config = dict(default_config)
+            axis_config.update( filter_config.get(axis['name'], {}) )
+            # an axis with all settings at zero keeps its unfiltered output
+            if any( axis_config.get(setting, 0.0) for setting in ('deadband', 'min_delta', 'quantize') ):
+                self.axis_filters[code] = AxisFilter( axis['max'],
+                                                      deadband=axis_config.get('deadband', 0.0),
+                                                      min_delta=axis_config.get('min_delta', 0.0),
+                                                      quantize=axis_config.get('quantize', 0.0) )
+                self.axis_controls[code].axis_filter = self.axis_filters[code]
+
+    def decode(self, event, decoded=None):
+        #
+        # decode an input event into a JoystickEvent, reusing the joystick's own instance
+        # unless the caller supplies one
+        #
+        if decoded is None:
+            decoded = self.decoded
+
+        control = self.dispatch[(event.type << self.DISPATCH_CODE_BITS) | event.code]
+        decoded.kind = control.kind
+        decoded.name = control.name
+        decoded.code = event.code
+
+        if control.kind == EVENT_AXIS:
+            axis_filter = control.axis_filter
+            if axis_filter:
+                value = axis_filter.apply(event.value)
+                if value is None:
+                    # the change is too small to be worth forwarding
+                    decoded.kind = EVENT_FILTERED
+                    value = axis_filter.last_value
+                decoded.value = value
             else:
-                logger.info( 'Unknown Event Type: %d, Code: %d, Value: %f' % (event.type, event.code, event.value) )
+                decoded.value = event.value * control.scale
+        else:
+            decoded.value = event.value
+
+        return decoded
+
+    def decode_event(self, event):
+        # dictionary based version of decode(), kept for compatibility
+        return self.decode( event, JoystickEvent() ).as_dict()
+
+    def read_frames(self, timeout=None):
+        #
+        # input pump that yields a JoystickFrame for every complete report from the gamepad.
+        # After each readiness notification all pending events are drained with the batch
+        # read(), see pending_frames(). timeout is the longest time to wait for input in
+        # seconds, or a function returning it, and None is yielded when it expires without
+        # a complete frame.
+        #
+        frame = JoystickFrame()
+        gamepad = self.gamepad
+        while True:
+            wait = timeout() if callable(timeout) else timeout
+            readable, _, _ = select.select( [gamepad], [], [], wait )
+            if not readable:
+                yield None
+                continue
+
+            yield from self.pending_frames( frame )
+
+    def pending_frames(self, frame):
+        #
+        # drain the events that are pending on the device without blocking, decoding them into
+        # frame and yielding it each time an EV_SYN event completes it. A batch read() returns
+        # up to 64 events per system call. Events that follow the last EV_SYN are left in the
+        # frame to be completed by the next call.
+        #
+        gamepad = self.gamepad
+        while True:
+            try:
+                events = list( gamepad.read() )
+            except BlockingIOError:
+                break
+
+            for event in events:
+                decoded_event = self.decode( event, frame.next_event() )
+                if decoded_event.kind == EVENT_SYN:
+                    yield frame
+                    frame.clear()
+
+            # a short batch means the device has been drained, so skip the read that
+            # would only fail with BlockingIOError
+            if len(events) < self.READ_BATCH_SIZE:
+                break
+
+    def read(self):
+        for frame in self.read_frames():
+            for decoded_event in frame:
+                if decoded_event.kind == EVENT_SYN or decoded_event.kind == EVENT_FILTERED:
+                    # ignore the SYN event types, not much to do with them
+                    pass
+                elif decoded_event.kind == EVENT_BUTTON:
+                    processed_state = self.BUTTON_STATES.get(decoded_event.value, 'UNKNOWN')
+                    logger.debug( 'Button Type: %s, Value: %s' % (decoded_event.name, processed_state) )
+                elif decoded_event.kind == EVENT_AXIS:
+                    logger.debug( 'Axis Type: %s, Value: %f' % (decoded_event.name, decoded_event.value) )
+                else:
+                    logger.info( 'Unknown Event Code: %d, Value: %f' % (decoded_event.code, decoded_event.value) )
 
 if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
@@ -5,9 +5,120 @@ import threading
 import time
 import traceback
 
+from collections import deque, namedtuple
+
+import numpy as np
 from rplidar import RPLidar
 
 from logger import logger
+from scan_log import ScanRecorder
+
+#
+# CaptureZone is the compiled form of a set of capture ranges. The zone is stored as a
+# membership table with BINS_PER_DEGREE bins for every degree of the revolution, so checking
+# whether a measurement falls inside the zone is a single table lookup. A range whose start
+# angle is greater than its end angle wraps around 0 degrees (e.g. '300-60'), and the range
+# end points are inclusive.
+#
+class CaptureZone(object):
+    BINS_PER_DEGREE = 4
+
+    def __init__(self, ranges):
+        self.ranges = []
+        self.num_bins = 360 * self.BINS_PER_DEGREE
+        self.table = np.zeros(self.num_bins, dtype=bool)
+
+        for range in ranges:
+            start = int(range[0]) % 360
+            end = min(int(range[1]), 359)
+            self.ranges.append( (start,end) )
+
+            start_bin = start * self.BINS_PER_DEGREE
+            end_bin = (end + 1) * self.BINS_PER_DEGREE
+            if start <= end:
+                self.table[start_bin:end_bin] = True
+            else:
+                self.table[start_bin:] = True
+                self.table[:end_bin] = True
+
+        # plain list copy of the table for the per-measurement lookups, which is faster than
+        # indexing into the numpy array one element at a time
+        self.lookup = self.table.tolist()
+
+    @classmethod
+    def from_string(cls, range_str):
+        #
+        # parse a comma-separated set of ranges (e.g. '0-45,315-359')
+        #
+        ranges = []
+        for range in range_str.replace(' ','').split(','):
+            range_spec = range.split('-')
+            ranges.append( (int(range_spec[0]),int(range_spec[1])) )
+        return cls(ranges)
+
+    def contains(self, angle):
+        return self.lookup[int(angle * self.BINS_PER_DEGREE) % self.num_bins]
+
+    def mask(self, angles):
+        return self.table[(angles * self.BINS_PER_DEGREE).astype(np.intp) % self.num_bins]
+
+    def __str__(self):
+        return ','.join( '%d-%d' % range for range in self.ranges )
+
+#
+# Work arrays for reducing the revolutions of one capture zone, preallocated for the most
+# measurements seen in a revolution so far and reused from one revolution to the next. Each
+# revolution is loaded into the arrays in place, and selected flags the measurements that
+# pass the zone and distance tests.
+#
+class ScanBuffers(object):
+    def __init__(self, zone, size=1024):
+        self.zone = zone
+        self.allocate( size )
+
+    def allocate(self, size):
+        self.measurements = np.empty( (size, 3), dtype=np.float64 )
+        self.bins = np.empty( size, dtype=np.intp )
+        self.distances = np.empty( size, dtype=np.float64 )
+        self.selected = np.empty( size, dtype=bool )
+        self.in_distance = np.empty( size, dtype=bool )
+        self.selected_angles = np.empty( size, dtype=np.float64 )
+        self.selected_distances = np.empty( size, dtype=np.float64 )
+
+    def load(self, scan, min_distance):
+        #
+        # load a revolution, returning its number of measurements. The distances are converted
+        # to inches, and selected flags the measurements in the zone and within min_distance
+        #
+        count = len(scan)
+        if count > len(self.bins):
+            self.allocate( max(count, 2 * len(self.bins)) )
+        if count == 0:
+            return 0
+
+        measurements = self.measurements[:count]
+        measurements[...] = scan
+        bins = self.bins[:count]
+        np.multiply( measurements[:,1], CaptureZone.BINS_PER_DEGREE, out=self.distances[:count] )
+        np.copyto( bins, self.distances[:count], casting='unsafe' )
+        np.remainder( bins, self.zone.num_bins, out=bins )
+        np.take( self.zone.table, bins, out=self.selected[:count] )
+
+        np.divide( measurements[:,2], 25.4, out=self.distances[:count] )
+        np.less_equal( self.distances[:count], min_distance, out=self.in_distance[:count] )
+        np.logical_and( self.selected[:count], self.in_distance[:count], out=self.selected[:count] )
+        return count
+
+#
+# ScanSnapshot is the immutable record of the closest measurement published by the scan
+# thread. The scan thread builds a complete new snapshot and publishes it with a single
+# reference assignment, so the control loop always reads a consistent record without taking
+# a lock. The sequence number increases with every publish and the revolution counter with
+# every LIDAR revolution, which lets consumers detect when they are looking at stale data.
+# When target tracking is enabled, target_id identifies the tracked object being reported.
+#
+ScanSnapshot = namedtuple( 'ScanSnapshot', ['valid', 'distance', 'angle', 'timestamp', 'revolution', 'sequence', 'target_id'],
+                           defaults=(None,) )
 
 #
 # Lidar is a class derived from the base RP Lidar class which contains all the
@@ -22,63 +133,184 @@ class Lidar(RPLidar):
     def __init__(self, port='/dev/ttyUSB0', debug=False):
         super().__init__( port )       
 
+        self.init_scan_state(debug)
+
+    def init_scan_state(self, debug=False):
+        #
+        # initialize the state used by the higher level scan operations. This is separate from
+        # the constructor so that scan backends that don't talk to a device (e.g. replay) can
+        # set up the same state without opening the serial port.
+        #
         self.debug = debug
         self.cancel_scan = False
         self.capture_ranges = None
-        self.scan_lock = threading.Lock()
+        self.capture_zone = None
+
+        # event set by the scan thread whenever a new reduced sample is ready, used by the
+        # event-driven sampling mode in closest_in_range
+        self.sample_ready = threading.Event()
+
+        # optional function called from the scan thread along with sample_ready, used to wake
+        # up a consumer that isn't a thread, e.g. an asyncio event loop
+        self.sample_listener = None
 
         # set the max distance to 25 meters, converting to inches for ease of use
         self.MAX_DISTANCE = int(25 * 39.37)
 
+        # optional recorder that captures every raw revolution to a scan log
+        self.recorder = None
+
         self.reset_closest()
 
-    def get_closest(self):
-        with self.scan_lock:
-            closest = self.closest
-        return closest
+    def start_recording(self, filename):
+        self.stop_recording()
+        logger.info( 'Recording LIDAR scans to %s' % filename )
+        self.recorder = ScanRecorder(filename)
 
-    def reset_closest(self):
-        with self.scan_lock:
-            self.closest = { 'valid': False, 'distance': self.MAX_DISTANCE, 'angle': 0 }
+    def stop_recording(self):
+        if self.recorder:
+            logger.info( 'Recorded %d LIDAR revolutions' % self.recorder.num_revolutions )
+            self.recorder.close()
+            self.recorder = None
 
-    def update_closest(self, distance, angle):
-        with self.scan_lock:
-            if distance < self.closest['distance']:
-                self.closest['distance'] = distance
-                self.closest['angle'] = angle
-                self.closest['valid'] = True
+    def get_snapshot(self):
+        return self.snapshot
 
-    def range_scan(self, ranges=((0,359)), min_distance=42):
+    def get_closest(self):
+        # hand back a copy of the latest snapshot so consumers are free to hold on to it
+        return self.snapshot._asdict()
+
+    def reset_closest(self):
+        self.revolution = 0
+        self.sequence = 0
+        self.snapshot = ScanSnapshot( False, self.MAX_DISTANCE, 0, time.monotonic(), 0, 0 )
+
+    def publish_closest(self, distance, angle, valid=True, notify=True, target_id=None):
+        # only the scan thread publishes snapshots, so the counters need no locking
+        self.sequence += 1
+        self.snapshot = ScanSnapshot( valid, distance, angle, time.monotonic(), self.revolution, self.sequence, target_id )
+        if notify:
+            self.sample_ready.set()
+            if self.sample_listener:
+                self.sample_listener()
+
+    def zone_measurements(self, scan, buffers, min_distance):
+        #
+        # convert a full revolution to angle/distance arrays holding only the measurements in
+        # the capture zone and within min_distance. The arrays are views into the buffers, so
+        # they are only valid until the next revolution is loaded.
+        #
+        count = buffers.load( scan, min_distance )
+        selected = buffers.selected[:count]
+        num_selected = int( np.count_nonzero(selected) )
+        angles = buffers.selected_angles[:num_selected]
+        distances = buffers.selected_distances[:num_selected]
+        np.compress( selected, buffers.measurements[:count,1], out=angles )
+        np.compress( selected, buffers.distances[:count], out=distances )
+        return angles, distances
+
+    def reduce_scan(self, scan, buffers, min_distance):
+        #
+        # reduce a full revolution to the closest measurement in the capture zone with a
+        # single argmin, over the distances with those of the unselected measurements masked
+        #
+        count = buffers.load( scan, min_distance )
+        if count == 0:
+            return self.MAX_DISTANCE, 0
+
+        distances = buffers.distances[:count]
+        np.logical_not( buffers.selected[:count], out=buffers.in_distance[:count] )
+        np.copyto( distances, np.inf, where=buffers.in_distance[:count] )
+        closest = int( np.argmin(distances) )
+        if distances[closest] == np.inf:
+            return self.MAX_DISTANCE, 0
+        return float(distances[closest]), int(buffers.measurements[closest,1])
+
+    def range_scan(self, zone, min_distance=42, tracker=None):
         self.debug = True
         if self.debug:
-            logger.debug( 'Capture Ranges: %s' % str(ranges) )
+            logger.debug( 'Capture Ranges: %s' % str(zone) )
 
+        buffers = ScanBuffers( zone )
         for i, scan in enumerate(self.iter_scans()):
-
-            scan_map = [self.MAX_DISTANCE] * 360
-
-            for measurement in scan:
-                if self.cancel_scan:
-                    return
-
-                distance = measurement[2]/25.4
-                try:
-                    if distance <= min_distance:
-                        scan_map[int(measurement[1])] = distance
-                except IndexError:
-                    try:
-                        scan_map[(int(measurement[1])-360)] = distance
-                    except IndexError:
-                        logger.info( 'Error indexing into scan map - %d' % int(measurement[1]) )
-
-            for range in ranges:
-                curr_closest = min(scan_map[range[0]:range[1]])
-                curr_angle = scan_map.index(curr_closest) 
-                self.update_closest( curr_closest, curr_angle )
-
-    def cancel(self):
+            if self.cancel_scan:
+                return
+
+            if self.recorder:
+                self.recorder.write(scan)
+
+            self.revolution += 1
+            if tracker:
+                # report the tracked target rather than the closest point, so that stray
+                # reflections don't pull the robot off of the object it is following
+                angles, distances = self.zone_measurements( scan, buffers, min_distance )
+                target = tracker.update( angles, distances, time.monotonic() )
+                if target and target.misses == 0:
+                    self.publish_closest( target.cluster.distance, int(target.cluster.angle), target_id=target.track_id )
+                else:
+                    self.publish_closest( self.MAX_DISTANCE, 0, valid=False )
+            else:
+                curr_closest, curr_angle = self.reduce_scan( scan, buffers, min_distance )
+                self.publish_closest( curr_closest, curr_angle, valid=(curr_closest < self.MAX_DISTANCE) )
+
+    def stream_scan(self, zone, min_distance=42, window=0.1):
+        #
+        # streaming variant of range_scan built on iter_measures(). Each in-zone measurement is
+        # pushed onto a monotonic queue that holds the sliding-window minimum over the last
+        # `window` seconds (roughly one rotation), and the current minimum is published after
+        # every measurement instead of once per revolution.
+        #
+        self.debug = True
+        if self.debug:
+            logger.debug( 'Streaming Capture Ranges: %s, Window: %0.3f' % (str(zone), window) )
+
+        # each entry is (timestamp, distance, angle), with distances strictly increasing from
+        # the front of the queue so that the front entry is always the window minimum
+        window_min = deque()
+
+        # raw measurements of the current revolution, collected only when recording
+        revolution_scan = []
+
+        for new_scan, quality, angle, distance in self.iter_measures():
+            if self.cancel_scan:
+                return
+
+            if new_scan:
+                self.revolution += 1
+                if self.recorder and revolution_scan:
+                    self.recorder.write(revolution_scan)
+                revolution_scan = []
+
+            if self.recorder and distance > 0:
+                revolution_scan.append( (quality, angle, distance) )
+
+            now = time.monotonic()
+            expired = now - window
+            while window_min and window_min[0][0] < expired:
+                window_min.popleft()
+
+            if distance > 0 and zone.contains(angle):
+                distance = distance/25.4
+                if distance <= min_distance:
+                    while window_min and window_min[-1][1] >= distance:
+                        window_min.pop()
+                    window_min.append( (now, distance, int(angle)) )
+
+            if window_min:
+                # publish every measurement, but only wake up an event-driven consumer when
+                # the closest point in the window has actually changed
+                snapshot = self.snapshot
+                changed = not snapshot.valid or snapshot.distance != window_min[0][1] or snapshot.angle != window_min[0][2]
+                self.publish_closest( window_min[0][1], window_min[0][2], notify=changed )
+            elif self.snapshot.valid:
+                # the window has emptied, so publish once that there is no longer a target
+                self.publish_closest( self.MAX_DISTANCE, 0, valid=False )
+
+    def cancel(self, wait=True):
+        # without wait, only ask the scan thread to stop, e.g. from an event loop that mustn't block
         self.cancel_scan = True
-        self.scan_thread.join()
+        if wait:
+            self.scan_thread.join()
 
     def terminate(self):
         self.stop()
@@ -86,26 +318,75 @@ class Lidar(RPLidar):
         self.disconnect()
 
     def build_ranges(self,range_str):
-        self.capture_ranges = []
-        ranges = range_str.replace(' ','').split(',')
-        for range in ranges:
-            range_spec = range.split('-')
-            self.capture_ranges.append( (int(range_spec[0]),int(range_spec[1])) )
+        self.capture_zone = CaptureZone.from_string(range_str)
+        self.capture_ranges = self.capture_zone.ranges
 
-    def closest_in_range(self, ranges=None, min_distance=42, sample_interval=0.05, callback=None):
+    #
+    # Run the scan in a background thread and pass samples of the closest measurement in the
+    # capture zone to the callback. By default the samples are polled every sample_interval.
+    # In the event-driven mode the callback runs as soon as the scan thread signals that a new
+    # sample is ready, and max_period acts as a watchdog so that the callback still runs (with
+    # an invalid sample if nothing new was published) when the scan stops producing data.
+    #
+    # If a TargetTracker is supplied, the samples report the tracked target instead of the
+    # closest point. Tracking works on full revolutions and is not available when streaming.
+    # If a sample filter (see lidar_filters) is supplied, every sample passes through it
+    # before it reaches the callback.
+    #
+    def closest_in_range(self, ranges=None, min_distance=42, sample_interval=0.05, callback=None,
+                         streaming=False, window=0.1, event_driven=False, max_period=0.05, tracker=None,
+                         sample_filter=None):
 
+        self.start_scan( ranges, min_distance, streaming, window, tracker )
+
+        last_sequence = self.snapshot.sequence
+        while self.cancel_scan == False:
+            if event_driven:
+                self.sample_ready.wait(max_period)
+                self.sample_ready.clear()
+            else:
+                time.sleep(sample_interval)
+            scan_data, last_sequence = self.take_sample( last_sequence, sample_filter )
+            if callback:
+                callback( scan_data )
+
+    def start_scan(self, ranges=None, min_distance=42, streaming=False, window=0.1, tracker=None):
+        #
+        # launch the scan thread that publishes the closest object snapshots. The samples are
+        # consumed with take_sample(), either by closest_in_range or by an asyncio runtime
+        #
         if ranges == None:
-            ranges = self.capture_ranges
+            zone = self.capture_zone
+        elif isinstance(ranges, CaptureZone):
+            zone = ranges
+        else:
+            zone = CaptureZone(ranges)
 
+        # the scan thread is not running yet, so it is safe to reset the published snapshot
         self.cancel_scan = False
-        self.scan_thread = threading.Thread(target=self.range_scan, args=(ranges,min_distance,))
+        self.reset_closest()
+        self.sample_ready.clear()
+        if streaming:
+            if tracker:
+                logger.info( 'Target tracking is not supported in streaming mode, tracking disabled' )
+            self.scan_thread = threading.Thread(target=self.stream_scan, args=(zone,min_distance,window,))
+        else:
+            self.scan_thread = threading.Thread(target=self.range_scan, args=(zone,min_distance,tracker,))
         self.scan_thread.start()
 
-        while self.cancel_scan == False:
-            time.sleep(sample_interval)
-            if callback:
-                callback( self.get_closest() )
-            self.reset_closest()
+    def take_sample(self, last_sequence, sample_filter=None):
+        #
+        # return the latest sample as a scan data dictionary along with its sequence number.
+        # The sample is reported as invalid if nothing has been published since last_sequence
+        #
+        snapshot = self.get_snapshot()
+        if snapshot.sequence == last_sequence:
+            # nothing has been published since the last sample, so report no update
+            snapshot = snapshot._replace( valid=False )
+        scan_data = snapshot._asdict()
+        if sample_filter:
+            scan_data = sample_filter.apply( scan_data )
+        return scan_data, snapshot.sequence
 
     def print_scan_data(self,scan_data):
         if scan_data.get('valid', False)==True:
@@ -122,6 +403,9 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--distance', action='store', dest='distance', default='42')
     parser.add_argument('-r', '--range', action='store', dest='range', default='0-359')
     parser.add_argument('-p', '--port', action='store', dest='port', default='/dev/ttyUSB0')
+    parser.add_argument('-s', '--streaming', action='store_true', dest='streaming', default=False)
+    parser.add_argument('-e', '--event', action='store_true', dest='event_driven', default=False)
+    parser.add_argument('--record', action='store', dest='record', default=None)
     options = parser.parse_args()
 
     if options.debug:
@@ -132,11 +416,7 @@ if __name__ == '__main__':
     # set of ranges (e.g. '0-45,315-360' will capture the 90 degrees towards the front
     # of the LIDAR device). 
     #
-    capture_ranges = []
-    ranges = options.range.replace(' ','').split(',')
-    for range in ranges:
-        range_spec = range.split('-')
-        capture_ranges.append( (int(range_spec[0]),int(range_spec[1])) )
+    capture_zone = CaptureZone.from_string(options.range)
 
     # initialize the lidar device itself
     lidar = Lidar(options.port, options.debug)
@@ -147,14 +427,18 @@ if __name__ == '__main__':
     logger.debug(lidar.get_info())
     logger.debug(lidar.get_health())
 
+    if options.record:
+        lidar.start_recording(options.record)
+
     #
     # perform the requested scan operation
     #
     try:
 
         # launch the operation which will terminate only upon either an exception or a keyboard interrupt (ctrl-C)
-        lidar.closest_in_range(ranges=capture_ranges, min_distance=int(options.distance),
-                               sample_interval=0.05, callback=lidar.print_scan_data)
+        lidar.closest_in_range(ranges=capture_zone, min_distance=int(options.distance),
+                               sample_interval=0.05, callback=lidar.print_scan_data,
+                               streaming=options.streaming, event_driven=options.event_driven)
 
     except KeyboardInterrupt:
         logger.debug( 'Canceling LIDAR scan' )
@@ -167,6 +451,7 @@ if __name__ == '__main__':
     # we need to cleanly shut down the LIDAR device before exiting
     #
     logger.info( 'Shutting down LIDAR' )
+    lidar.stop_recording()
     lidar.terminate()
 
     logger.info( 'Done' )
@@ -0,0 +1,172 @@
+from bisect import bisect_left
+
+from logger import logger
+
+#
+# Temporal filters for the closest object samples that are passed from Lidar.closest_in_range
+# to the control callbacks. The filters smooth out the measurement jitter that would otherwise
+# make the robot speed flip between two settings when a target sits on a speed boundary.
+#
+# Each filter runs in constant time per sample using preallocated state. The angle is filtered
+# as a signed offset from straight ahead (-180 to 180 degrees) so that a target that moves
+# across 0 degrees doesn't get averaged to the opposite side of the robot. Invalid samples are
+# passed through untouched, and the filter state is reset after reset_after invalid samples in
+# a row or when the tracked target changes, so that a new target doesn't inherit the history
+# of the previous one.
+#
+class SampleFilter(object):
+    def __init__(self, reset_after=5):
+        self.reset_after = reset_after
+        self.invalid_count = 0
+        self.target_id = None
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def filter(self, angle, distance):
+        return angle, distance
+
+    def apply(self, scan_data):
+        if scan_data.get('valid', False) != True:
+            self.invalid_count += 1
+            if self.invalid_count == self.reset_after:
+                self.reset()
+            return scan_data
+
+        self.invalid_count = 0
+        target_id = scan_data.get('target_id', None)
+        if target_id != self.target_id:
+            self.target_id = target_id
+            self.reset()
+
+        # filter the angle as a signed offset from straight ahead
+        angle = ((scan_data['angle'] + 180.0) % 360.0) - 180.0
+        angle, distance = self.filter( angle, scan_data['distance'] )
+
+        filtered = dict(scan_data)
+        filtered['angle'] = angle % 360.0
+        filtered['distance'] = distance
+        return filtered
+
+#
+# Exponential smoothing, where alpha is the weight given to the newest sample
+#
+class ExponentialFilter(SampleFilter):
+    def __init__(self, alpha=0.5, reset_after=5):
+        self.alpha = alpha
+        super().__init__(reset_after)
+
+    def reset(self):
+        self.angle = None
+        self.distance = None
+
+    def filter(self, angle, distance):
+        if self.angle is None:
+            self.angle = angle
+            self.distance = distance
+        else:
+            self.angle += self.alpha * (angle - self.angle)
+            self.distance += self.alpha * (distance - self.distance)
+        return self.angle, self.distance
+
+#
+# Median of the last size samples, which rejects single-sample outliers entirely. Alongside the
+# ring buffers of the samples, the window is kept sorted in place: each new sample replaces the
+# oldest one in the sorted window by an insertion sort step, so no lists are built per sample
+#
+class MedianFilter(SampleFilter):
+    def __init__(self, size=5, reset_after=5):
+        self.size = size
+        self.angles = [0.0] * size
+        self.distances = [0.0] * size
+        self.sorted_angles = [0.0] * size
+        self.sorted_distances = [0.0] * size
+        super().__init__(reset_after)
+
+    def reset(self):
+        self.index = 0
+        self.count = 0
+
+    def filter(self, angle, distance):
+        full = self.count == self.size
+        replace_sorted( self.sorted_angles, self.count, angle, self.angles[self.index] if full else None )
+        replace_sorted( self.sorted_distances, self.count, distance, self.distances[self.index] if full else None )
+
+        self.angles[self.index] = angle
+        self.distances[self.index] = distance
+        self.index = (self.index + 1) % self.size
+        if not full:
+            self.count += 1
+
+        middle = self.count // 2
+        return self.sorted_angles[middle], self.sorted_distances[middle]
+
+#
+# Insert value into the sorted window values[:count], in place. If oldest is given, the window
+# is full and value takes the place of oldest, otherwise the window grows by one
+#
+def replace_sorted(values, count, value, oldest=None):
+    if oldest is None:
+        i = count
+        last = count
+    else:
+        i = bisect_left( values, oldest, 0, count )
+        last = count - 1
+
+    while i > 0 and values[i-1] > value:
+        values[i] = values[i-1]
+        i -= 1
+    while i < last and values[i+1] < value:
+        values[i] = values[i+1]
+        i += 1
+    values[i] = value
+
+#
+# Scalar Kalman filter applied independently to the angle and the distance, modelling each
+# as a random walk with the given process noise, observed with the given measurement noise
+#
+class KalmanFilter(SampleFilter):
+    def __init__(self, process_noise=1.0, measurement_noise=4.0, reset_after=5):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        super().__init__(reset_after)
+
+    def reset(self):
+        self.state = None
+        self.variance = [ self.measurement_noise, self.measurement_noise ]
+
+    def filter(self, angle, distance):
+        if self.state is None:
+            self.state = [ angle, distance ]
+            return angle, distance
+
+        for i, measurement in enumerate( (angle, distance) ):
+            variance = self.variance[i] + self.process_noise
+            gain = variance / (variance + self.measurement_noise)
+            self.state[i] += gain * (measurement - self.state[i])
+            self.variance[i] = (1.0 - gain) * variance
+        return self.state[0], self.state[1]
+
+#
+# Create the sample filter described by a filter configuration section, e.g.
+#     { "type": "median", "size": 5 }
+# Returns None if no filter is configured.
+#
+def create_filter(filter_config):
+    if not filter_config:
+        return None
+
+    filter_type = filter_config.get('type', 'none').lower()
+    reset_after = filter_config.get('reset_after', 5)
+    if filter_type == 'ema':
+        return ExponentialFilter( alpha=filter_config.get('alpha', 0.5), reset_after=reset_after )
+    elif filter_type == 'median':
+        return MedianFilter( size=filter_config.get('size', 5), reset_after=reset_after )
+    elif filter_type == 'kalman':
+        return KalmanFilter( process_noise=filter_config.get('process_noise', 1.0),
+                             measurement_noise=filter_config.get('measurement_noise', 4.0),
+                             reset_after=reset_after )
+    elif filter_type != 'none':
+        logger.error( 'Unknown LIDAR Filter Type: %s' % filter_type )
+    return None
@@ -0,0 +1,126 @@
+import argparse
+import logging
+import time
+
+from lidar import Lidar, CaptureZone
+from logger import logger
+from scan_log import read_scans
+
+#
+# ReplayLidar is a drop-in replacement for the Lidar class that plays back a scan log that
+# was captured with Lidar.start_recording() instead of reading from a physical device. The
+# scans are replayed either at the pace at which they were recorded or, with realtime set to
+# False, as fast as the consumer can take them. All of the higher level scan operations
+# (closest_in_range, range_scan, stream_scan) run unchanged on top of the replayed data.
+#
+# The replay can start at any revolution in the log (start_revolution). When the end of the
+# recording is reached the scan is canceled, so that closest_in_range returns just as it would
+# when the scan is canceled on a live device.
+#
+class ReplayLidar(Lidar):
+
+    def __init__(self, filename, realtime=True, start_revolution=0, debug=False):
+        # the RPLidar constructor would open the serial port, so it is deliberately skipped
+        self.filename = filename
+        self.realtime = realtime
+        self.start_revolution = start_revolution
+        self.init_scan_state(debug)
+
+    def replay_scans(self):
+        #
+        # generator yielding the (timestamp, scan) revolutions from the log, sleeping as needed
+        # to reproduce the recorded timing when replaying in real time
+        #
+        start_time = None
+        first_timestamp = None
+        for timestamp, scan in read_scans(self.filename, self.start_revolution):
+            if self.realtime:
+                if start_time is None:
+                    start_time = time.monotonic()
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+            yield timestamp, scan
+
+        logger.info( 'End of LIDAR replay: %s' % self.filename )
+        self.cancel_scan = True
+
+    def iter_scans(self, scan_type='normal', max_buf_meas=3000, min_len=5):
+        for timestamp, scan in self.replay_scans():
+            if len(scan) > min_len:
+                yield scan
+
+    def iter_measures(self, scan_type='normal', max_buf_meas=3000):
+        #
+        # the recording holds whole revolutions, so the individual measurements are spread
+        # evenly across the time between one revolution and the next when replaying in real time
+        #
+        prev_timestamp = None
+        for timestamp, scan in self.replay_scans():
+            interval = 0.0
+            if self.realtime and prev_timestamp is not None and len(scan) > 0:
+                interval = (timestamp - prev_timestamp) / len(scan)
+            prev_timestamp = timestamp
+
+            for index, (quality, angle, distance) in enumerate(scan):
+                if interval and index:
+                    time.sleep(interval)
+                yield (index == 0), quality, angle, distance
+
+    def get_info(self):
+        return { 'model': 'replay', 'firmware': (0, 0), 'hardware': 0, 'serialnumber': self.filename }
+
+    def get_health(self):
+        return ( 'Good', 0 )
+
+    def stop(self):
+        pass
+
+    def stop_motor(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+if __name__ == '__main__':
+
+    #
+    # parse out the command arguments
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true', dest='debug', default=False)
+    parser.add_argument('-f', '--file', action='store', dest='file', required=True)
+    parser.add_argument('-d', '--distance', action='store', dest='distance', default='42')
+    parser.add_argument('-r', '--range', action='store', dest='range', default='0-359')
+    parser.add_argument('-s', '--streaming', action='store_true', dest='streaming', default=False)
+    parser.add_argument('-e', '--event', action='store_true', dest='event_driven', default=False)
+    parser.add_argument('--fast', action='store_true', dest='fast', default=False)
+    parser.add_argument('--start', action='store', dest='start', default='0')
+    options = parser.parse_args()
+
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+
+    lidar = ReplayLidar(options.file, realtime=not options.fast, start_revolution=int(options.start), debug=options.debug)
+
+    #
+    # replay the recording through the same scan operation used on the robot, reporting the
+    # number of samples delivered and how long the replay took
+    #
+    samples = { 'total': 0, 'valid': 0 }
+    def count_samples(scan_data):
+        samples['total'] += 1
+        if scan_data.get('valid', False)==True:
+            samples['valid'] += 1
+        lidar.print_scan_data(scan_data)
+
+    start_time = time.monotonic()
+    lidar.closest_in_range(ranges=CaptureZone.from_string(options.range), min_distance=int(options.distance),
+                           sample_interval=0.05, callback=count_samples,
+                           streaming=options.streaming, event_driven=options.event_driven)
+    lidar.scan_thread.join()
+
+    logger.info( 'Replayed %d revolutions in %0.2f seconds, %d samples (%d valid)' %
+                 (lidar.revolution, time.monotonic() - start_time, samples['total'], samples['valid']) )
@@ -0,0 +1,176 @@
+import math
+
+from collections import namedtuple
+
+import numpy as np
+
+from logger import logger
+
+#
+# Cluster is a group of adjacent LIDAR measurements that are assumed to belong to the same
+# object. The angle and position are taken from the centroid of the points in the cluster,
+# while the distance is that of the closest point so that the follow distance is measured
+# to the nearest edge of the object.
+#
+Cluster = namedtuple( 'Cluster', ['angle', 'distance', 'x', 'y', 'num_points'] )
+
+#
+# Group the measurements of a single revolution into clusters. Two measurements that are
+# next to each other by angle belong to the same cluster unless they are more than angle_gap
+# degrees apart or their distances differ by more than range_gap inches. The grouping is a
+# single vectorized pass over the (already zone filtered) measurements, and the cluster that
+# straddles 0 degrees is stitched back together.
+#
+def cluster_scan(angles, distances, angle_gap=3.0, range_gap=6.0, min_points=2):
+    if len(angles) == 0:
+        return []
+
+    order = np.argsort(angles)
+    angles = angles[order]
+    distances = distances[order]
+
+    breaks = (np.diff(angles) > angle_gap) | (np.abs(np.diff(distances)) > range_gap)
+    starts = np.concatenate( ([0], np.flatnonzero(breaks) + 1) )
+    labels = np.cumsum( np.concatenate(([0], breaks)) )
+
+    # merge the last cluster into the first one if they meet across 0 degrees
+    if len(starts) > 1:
+        wrap_gap = angles[0] + 360.0 - angles[-1]
+        if wrap_gap <= angle_gap and abs(distances[0] - distances[-1]) <= range_gap:
+            labels[labels == labels[-1]] = 0
+            starts = starts[:-1]
+
+    radians = np.radians(angles)
+    xs = distances * np.cos(radians)
+    ys = distances * np.sin(radians)
+
+    num_clusters = len(starts)
+    counts = np.bincount(labels, minlength=num_clusters)
+    sum_x = np.bincount(labels, weights=xs, minlength=num_clusters)
+    sum_y = np.bincount(labels, weights=ys, minlength=num_clusters)
+    min_distance = np.full(num_clusters, np.inf)
+    np.minimum.at(min_distance, labels, distances)
+
+    clusters = []
+    for i in range(num_clusters):
+        if counts[i] < min_points:
+            continue
+        x = float(sum_x[i] / counts[i])
+        y = float(sum_y[i] / counts[i])
+        angle = math.degrees(math.atan2(y, x)) % 360.0
+        clusters.append( Cluster(angle, float(min_distance[i]), x, y, int(counts[i])) )
+
+    return clusters
+
+#
+# A single tracked object with a constant-velocity estimate of its motion in the LIDAR frame
+#
+class Track(object):
+    def __init__(self, track_id, cluster, timestamp):
+        self.track_id = track_id
+        self.cluster = cluster
+        self.x = cluster.x
+        self.y = cluster.y
+        self.vx = 0.0
+        self.vy = 0.0
+        self.timestamp = timestamp
+        self.misses = 0
+
+    def predict(self, timestamp):
+        dt = timestamp - self.timestamp
+        return self.x + self.vx * dt, self.y + self.vy * dt
+
+    def update(self, cluster, timestamp, velocity_gain=0.5):
+        dt = timestamp - self.timestamp
+        if dt > 0:
+            # blend the measured velocity into the estimate to smooth out the measurement noise
+            self.vx += velocity_gain * ((cluster.x - self.x) / dt - self.vx)
+            self.vy += velocity_gain * ((cluster.y - self.y) / dt - self.vy)
+        self.x = cluster.x
+        self.y = cluster.y
+        self.cluster = cluster
+        self.timestamp = timestamp
+        self.misses = 0
+
+#
+# TargetTracker keeps a stable identity for the objects seen by the LIDAR from one revolution
+# to the next. The clusters of each revolution are associated with the existing tracks by
+# nearest neighbour against the constant-velocity prediction of each track, within a gate
+# distance (in inches). Once a target has been selected, the tracker keeps reporting that
+# same target for as long as its track survives, instead of jumping to whichever object
+# happens to be closest in a given revolution.
+#
+class TargetTracker(object):
+    def __init__(self, gate=18.0, max_misses=3, angle_gap=3.0, range_gap=6.0):
+        self.gate = gate
+        self.max_misses = max_misses
+        self.angle_gap = angle_gap
+        self.range_gap = range_gap
+        self.reset()
+
+    def reset(self):
+        self.tracks = []
+        self.next_id = 1
+        self.target_id = None
+
+    def update(self, angles, distances, timestamp):
+        clusters = cluster_scan( angles, distances, self.angle_gap, self.range_gap )
+
+        # build the list of all candidate track/cluster pairings inside the gate and
+        # assign them greedily, closest pairs first
+        pairs = []
+        for track_index, track in enumerate(self.tracks):
+            px, py = track.predict(timestamp)
+            for cluster_index, cluster in enumerate(clusters):
+                separation = math.hypot(cluster.x - px, cluster.y - py)
+                if separation <= self.gate:
+                    pairs.append( (separation, track_index, cluster_index) )
+        pairs.sort()
+
+        matched_tracks = set()
+        matched_clusters = set()
+        for separation, track_index, cluster_index in pairs:
+            if track_index in matched_tracks or cluster_index in matched_clusters:
+                continue
+            self.tracks[track_index].update( clusters[cluster_index], timestamp )
+            matched_tracks.add(track_index)
+            matched_clusters.add(cluster_index)
+
+        # age out the tracks that were not seen in this revolution
+        surviving = []
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    if track.track_id == self.target_id:
+                        logger.debug( 'Lost track of target %d' % track.track_id )
+                        self.target_id = None
+                    continue
+            surviving.append(track)
+        self.tracks = surviving
+
+        for cluster_index, cluster in enumerate(clusters):
+            if cluster_index not in matched_clusters:
+                self.tracks.append( Track(self.next_id, cluster, timestamp) )
+                self.next_id += 1
+
+        return self.get_target()
+
+    def get_target(self):
+        #
+        # return the track for the current target, selecting the closest visible object as
+        # the new target if there isn't one already
+        #
+        for track in self.tracks:
+            if track.track_id == self.target_id:
+                return track
+
+        candidates = [ track for track in self.tracks if track.misses == 0 ]
+        if not candidates:
+            return None
+
+        target = min( candidates, key=lambda track: track.cluster.distance )
+        self.target_id = target.track_id
+        logger.debug( 'Acquired target %d at distance: %0.1f, angle: %d' %
+                      (target.track_id, target.cluster.distance, int(target.cluster.angle)) )
+        return target
@@ -0,0 +1,133 @@
+import array
+import fcntl
+import struct
+import termios
+import time
+
+QUEUE_DEPTH = struct.pack( 'i', 0 )
+
+#
+# Rolling statistics of the datagram link to a robot, based on the sequence numbers of the
+# frames sent and the acknowledgements (or echoes) of those frames that the robot sends back.
+#
+# The send time of the last window frames is kept in a ring indexed by the sequence number, so
+# an acknowledgement is matched to its frame in constant time. The round trip time is measured
+# against the local send time, so the clocks of the two ends don't need to agree. A frame that
+# isn't acknowledged within loss_timeout seconds, or before it drops out of the window, is
+# counted as lost, but only once the robot has acknowledged anything at all, since a robot that
+# doesn't send acknowledgements would otherwise show a loss of 100%. An acknowledgement older
+# than the newest one received is counted as reordered. The depth of the socket send queue is
+# sampled as frames are sent, and the deepest queue seen is reported, as a queue building up in
+# the kernel is the first sign that the link can't keep up.
+#
+# The counters and the round trip times cover the frames since the last report().
+#
+PENDING = 0
+ACKED = 1
+LOST = 2
+
+class LinkStats(object):
+    def __init__(self, window=256, sequence_bits=16, loss_timeout=1.0):
+        self.window = window
+        self.loss_timeout = loss_timeout
+        self.sequence_mask = (1 << sequence_bits) - 1
+        self.send_times = array.array( 'd', [0.0] * window )
+        self.sequences = array.array( 'l', [-1] * window )
+        self.status = bytearray( window )
+        self.acks_seen = False
+        self.last_acked = None
+        self.reset()
+
+    def reset(self):
+        self.num_sent = 0
+        self.num_acked = 0
+        self.num_lost = 0
+        self.num_reordered = 0
+        self.queue_depth = 0
+        self.rtts = []
+
+    def sent(self, sequence, now=None):
+        if now is None:
+            now = time.monotonic()
+        index = sequence % self.window
+        if self.acks_seen and self.sequences[index] >= 0 and self.status[index] == PENDING:
+            self.num_lost += 1
+        self.sequences[index] = sequence
+        self.send_times[index] = now
+        self.status[index] = PENDING
+        self.num_sent += 1
+
+    def received(self, sequence, now=None):
+        if now is None:
+            now = time.monotonic()
+        index = sequence % self.window
+        if self.sequences[index] != sequence or self.status[index] != PENDING:
+            # too old to be matched, already counted as lost, or a duplicate
+            return
+
+        self.status[index] = ACKED
+        self.acks_seen = True
+        self.num_acked += 1
+        self.rtts.append( now - self.send_times[index] )
+
+        if self.last_acked is not None:
+            if (sequence - self.last_acked) & self.sequence_mask > self.sequence_mask // 2:
+                self.num_reordered += 1
+                return
+        self.last_acked = sequence
+
+    def sample_queue_depth(self, sock):
+        # number of bytes still waiting in the socket send queue (TIOCOUTQ, same as SIOCOUTQ)
+        try:
+            depth = struct.unpack( 'i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, QUEUE_DEPTH) )[0]
+        except OSError:
+            return 0
+        if depth > self.queue_depth:
+            self.queue_depth = depth
+        return depth
+
+    def percentile(self, rtts, fraction):
+        return rtts[ min(len(rtts) - 1, int(fraction * len(rtts))) ]
+
+    def expire(self, now):
+        # count the frames that have been waiting for their acknowledgement too long as lost
+        if not self.acks_seen:
+            return
+        expired = now - self.loss_timeout
+        for index in range(self.window):
+            if self.status[index] == PENDING and self.sequences[index] >= 0 and self.send_times[index] < expired:
+                self.status[index] = LOST
+                self.num_lost += 1
+
+    def report(self, now=None):
+        #
+        # return the statistics since the last report and start a new period. The loss rate is
+        # the fraction of the frames that were never acknowledged
+        #
+        self.expire( time.monotonic() if now is None else now )
+        stats = { 'sent': self.num_sent,
+                  'acked': self.num_acked,
+                  'lost': self.num_lost,
+                  'reordered': self.num_reordered,
+                  'loss_rate': self.num_lost / max(1, self.num_lost + self.num_acked),
+                  'queue_depth': self.queue_depth }
+
+        rtts = sorted( self.rtts )
+        if rtts:
+            stats['rtt_p50'] = self.percentile( rtts, 0.50 )
+            stats['rtt_p90'] = self.percentile( rtts, 0.90 )
+            stats['rtt_p99'] = self.percentile( rtts, 0.99 )
+            stats['rtt_max'] = rtts[-1]
+
+        self.reset()
+        return stats
+
+def format_stats(stats):
+    text = 'sent %d, acked %d, lost %d (%0.1f%%), reordered %d, queued %d bytes' % \
+           ( stats['sent'], stats['acked'], stats['lost'], stats['loss_rate'] * 100.0,
+             stats['reordered'], stats['queue_depth'] )
+    if 'rtt_p50' in stats:
+        text += ', rtt p50 %0.1f ms, p90 %0.1f ms, p99 %0.1f ms, max %0.1f ms' % \
+                ( stats['rtt_p50'] * 1000.0, stats['rtt_p90'] * 1000.0, stats['rtt_p99'] * 1000.0,
+                  stats['rtt_max'] * 1000.0 )
+    return text
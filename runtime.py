@@ -0,0 +1,192 @@
+import asyncio
+import signal
+
+from logger import logger
+
+#
+# AsyncRuntime runs a controller on a single asyncio event loop instead of a set of blocking
+# loops and threads. The gamepads, the LIDAR samples, the UDP socket and the timers are
+# all serviced by the same loop, so the callbacks of the controller never run concurrently.
+#
+# SIGINT and SIGTERM cancel the main task rather than exiting from inside the signal handler,
+# so that the pumps unregister themselves and the cleanup function runs once the loop has
+# unwound. The cleanup function may block (e.g. waiting for the LIDAR scan thread), so it runs
+# in an executor rather than on the loop.
+#
+class AsyncRuntime(object):
+    def __init__(self):
+        self.loop = None
+        self.main_task = None
+
+    def run(self, coroutine, cleanup=None):
+        asyncio.run( self.main(coroutine, cleanup) )
+
+    async def main(self, coroutine, cleanup=None):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler( signum, self.stop )
+
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            logger.info( 'Runtime canceled' )
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.remove_signal_handler( signum )
+            if cleanup:
+                await self.loop.run_in_executor( None, cleanup )
+
+    def stop(self):
+        if self.main_task:
+            self.main_task.cancel()
+
+    async def pump_gamepads(self, manager, frame_callback):
+        #
+        # call frame_callback with (slot, frame) for each complete frame reported by any of the
+        # gamepads of a DeviceManager. The inotify watch and every bound gamepad are registered
+        # with the loop, and gamepads are registered and unregistered as they come and go.
+        #
+        readers = {}
+        if not manager.bound_slots() and not manager.inotify:
+            logger.error( 'No gamepads to wait for' )
+            return
+
+        def register(slot, device):
+            if device:
+                fd = device.fileno()
+                readers[slot] = fd
+                self.loop.add_reader( fd, readable, slot )
+            elif slot in readers:
+                self.loop.remove_reader( readers.pop(slot) )
+
+        def readable(slot):
+            for frame in manager.pending_frames( slot ):
+                frame_callback( slot, frame )
+
+        for slot in manager.bound_slots():
+            register( slot, manager.joysticks[slot].gamepad )
+        manager.listeners.append( register )
+        if manager.inotify:
+            self.loop.add_reader( manager.fileno(), manager.process_events )
+
+        try:
+            await self.loop.create_future()
+        finally:
+            manager.listeners.remove( register )
+            if manager.inotify:
+                self.loop.remove_reader( manager.fileno() )
+            for fd in readers.values():
+                self.loop.remove_reader( fd )
+
+    async def pump_lidar(self, lidar, callback, ranges=None, min_distance=42, sample_interval=0.05,
+                         streaming=False, window=0.1, event_driven=False, max_period=0.05, tracker=None,
+                         sample_filter=None):
+        #
+        # asyncio version of Lidar.closest_in_range. The scan thread still reads the device, but
+        # the samples are taken and handed to the callback on the loop. In event-driven mode the
+        # scan thread wakes the loop when a sample is ready, at most once per sample taken.
+        #
+        # The callback may cancel the scan, but must not wait for the scan thread as that would
+        # block the loop for up to a revolution (see Lidar.cancel). The scan thread is joined
+        # from an executor once the pump has stopped.
+        #
+        ready = asyncio.Event()
+        wakeup_pending = [False]
+
+        def sample_listener():
+            # runs on the scan thread
+            if not wakeup_pending[0]:
+                wakeup_pending[0] = True
+                self.loop.call_soon_threadsafe( ready.set )
+
+        if event_driven:
+            lidar.sample_listener = sample_listener
+        lidar.start_scan( ranges, min_distance, streaming, window, tracker )
+        try:
+            last_sequence = lidar.snapshot.sequence
+            while lidar.cancel_scan == False:
+                if event_driven:
+                    try:
+                        await asyncio.wait_for( ready.wait(), max_period )
+                    except asyncio.TimeoutError:
+                        pass
+                    ready.clear()
+                    wakeup_pending[0] = False
+                else:
+                    await asyncio.sleep( sample_interval )
+                scan_data, last_sequence = lidar.take_sample( last_sequence, sample_filter )
+                callback( scan_data )
+        finally:
+            lidar.sample_listener = None
+            lidar.cancel_scan = True
+            await self.loop.run_in_executor( None, lidar.scan_thread.join )
+
+    async def drive_transport(self, transport):
+        #
+        # service a connection oriented transport (see transports.py) on the loop: its socket is
+        # watched for reading, and for writing while it has something to send, and it is polled
+        # to reconnect when its backoff expires
+        #
+        # the socket is tracked rather than its descriptor, as a new connection may reuse the
+        # descriptor of the socket that was just closed
+        registered = { 'sock': None, 'fd': None, 'writing': False }
+
+        def unregister():
+            if registered['sock'] is not None:
+                self.loop.remove_reader( registered['fd'] )
+                if registered['writing']:
+                    self.loop.remove_writer( registered['fd'] )
+            registered.update( sock=None, fd=None, writing=False )
+
+        def update():
+            sock = transport.sock
+            if sock is not registered['sock']:
+                unregister()
+                if sock is not None:
+                    registered.update( sock=sock, fd=sock.fileno() )
+                    self.loop.add_reader( registered['fd'], readable )
+            writing = sock is not None and transport.wants_write()
+            if writing != registered['writing']:
+                if writing:
+                    self.loop.add_writer( registered['fd'], writable )
+                else:
+                    self.loop.remove_writer( registered['fd'] )
+                registered['writing'] = writing
+
+        def readable():
+            transport.on_readable()
+            update()
+
+        def writable():
+            transport.on_writable()
+            update()
+
+        transport.wakeup = update
+        try:
+            while True:
+                transport.poll()
+                update()
+                timeout = transport.timeout()
+                await asyncio.sleep( 0.5 if timeout is None else min(timeout, 0.5) )
+        finally:
+            transport.wakeup = None
+            unregister()
+            transport.close()
+
+    async def open_udp(self, datagram_received=None):
+        #
+        # create an unconnected UDP endpoint for sending datagrams, returning its transport.
+        # datagram_received is called with (data, address) for every datagram received
+        #
+        transport, _ = await self.loop.create_datagram_endpoint( lambda: DatagramReceiver(datagram_received),
+                                                                 local_addr=('0.0.0.0', 0) )
+        return transport
+
+class DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, datagram_received=None):
+        self.callback = datagram_received
+
+    def datagram_received(self, data, address):
+        if self.callback:
+            self.callback( data, address )
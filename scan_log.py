@@ -0,0 +1,179 @@
+import os
+import struct
+import time
+
+import numpy as np
+
+#
+# Binary log of raw LIDAR revolutions, as produced by RPLidar.iter_scans().
+#
+# The log is laid out so that it can be read through numpy.memmap without loading it into
+# memory. The file starts with a fixed size header holding a magic string, the format version
+# and the record size, followed by fixed-width measurement records:
+#
+#     revolution (uint32), timestamp (float64), quality (uint8), angle (float32), distance (float32)
+#
+# The records of a revolution are stored back to back. Alongside the log, a revolution index
+# file (<log>.idx) holds the record number at which each revolution starts and its timestamp,
+# so any revolution can be located in O(1), including a revolution without any measurements.
+# The index can be rebuilt from the revolution numbers stored in the records if it is missing
+# or was not flushed (e.g. after a power loss on the robot).
+#
+# A revolution without any measurements is written as a single marker record, with NaN for the
+# angle and distance, that carries its revolution number and timestamp, so that a rebuilt index
+# keeps the empty revolution along with its timestamp. The revolution reads back empty.
+#
+LOG_MAGIC = b'SCAN'
+LOG_VERSION = 2
+
+FILE_HEADER = struct.Struct('<4sHH8x')
+
+RECORD_DTYPE = np.dtype( [ ('revolution', '<u4'),
+                           ('timestamp',  '<f8'),
+                           ('quality',    'u1'),
+                           ('angle',      '<f4'),
+                           ('distance',   '<f4') ] )
+
+INDEX_DTYPE = np.dtype( [ ('start',      '<u8'),
+                          ('timestamp',  '<f8') ] )
+
+def index_filename(filename):
+    return filename + '.idx'
+
+#
+# ScanRecorder appends revolutions to a scan log as they are captured
+#
+class ScanRecorder(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, 'wb')
+        self.fd.write( FILE_HEADER.pack(LOG_MAGIC, LOG_VERSION, RECORD_DTYPE.itemsize) )
+        self.index_fd = open(index_filename(filename), 'wb')
+        self.num_revolutions = 0
+        self.num_records = 0
+
+    def write(self, scan, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        records = np.empty(max(len(scan), 1), dtype=RECORD_DTYPE)
+        records['revolution'] = self.num_revolutions
+        records['timestamp'] = timestamp
+        if len(scan):
+            measurements = np.array(scan, dtype=np.float64)
+            # the express scan mode doesn't report a quality value
+            records['quality'] = np.nan_to_num(measurements[:,0])
+            records['angle'] = measurements[:,1]
+            records['distance'] = measurements[:,2]
+        else:
+            # marker record of an empty revolution
+            records['quality'] = 0
+            records['angle'] = np.nan
+            records['distance'] = np.nan
+
+        entry = np.array( [(self.num_records, timestamp)], dtype=INDEX_DTYPE )
+        self.index_fd.write( entry.tobytes() )
+        self.fd.write( records.tobytes() )
+        self.num_records += len(records)
+        self.num_revolutions += 1
+
+    def close(self):
+        if self.fd:
+            self.fd.close()
+            self.index_fd.close()
+            self.fd = None
+            self.index_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#
+# ScanLog provides zero-copy, random access to a scan log. The records are memory mapped, so
+# only the pages that are actually touched are read from disk, and each revolution is returned
+# as a view into the mapped file.
+#
+class ScanLog(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, 'rb') as fd:
+            magic, version, record_size = FILE_HEADER.unpack( fd.read(FILE_HEADER.size) )
+        if magic != LOG_MAGIC or version != LOG_VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError( 'Unsupported scan log: %s' % filename )
+
+        # ignore a partially written trailing record
+        num_records = (os.path.getsize(filename) - FILE_HEADER.size) // RECORD_DTYPE.itemsize
+        if num_records > 0:
+            self.records = np.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=FILE_HEADER.size, shape=(num_records,))
+        else:
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+
+        self.starts = self.load_index()
+
+    def load_index(self):
+        #
+        # load the revolution index, rebuilding it from the records if the index file is
+        # missing or doesn't cover all of the records
+        #
+        num_records = len(self.records)
+        try:
+            with open(index_filename(self.filename), 'rb') as fd:
+                data = fd.read()
+            # ignore a partially written trailing entry
+            data = data[ : len(data) - len(data) % INDEX_DTYPE.itemsize ]
+            index = np.frombuffer(data, dtype=INDEX_DTYPE)
+        except OSError:
+            index = np.empty(0, dtype=INDEX_DTYPE)
+
+        num_revolutions = int(self.records['revolution'][-1]) + 1 if num_records else 0
+        starts = index['start']
+        if len(index) < num_revolutions or np.any(starts > num_records) or np.any(np.diff(starts.astype(np.int64)) < 0):
+            # every revolution has at least one record, a marker record if it is empty
+            revolutions = self.records['revolution'].astype(np.int64)
+            starts = np.flatnonzero( np.diff(revolutions, prepend=-1) )
+            index = np.empty(len(starts), dtype=INDEX_DTYPE)
+            index['start'] = starts
+            index['timestamp'] = self.records['timestamp'][starts]
+
+        self.timestamps = np.array( index['timestamp'] )
+        # a revolution that starts with a marker record is empty
+        if num_records:
+            first = np.minimum( index['start'], num_records - 1 ).astype(np.intp)
+            self.empty = (index['start'] >= num_records) | np.isnan( self.records['distance'][first] )
+        else:
+            self.empty = np.ones( len(index), dtype=bool )
+        # append the end of the last revolution so that revolution i spans starts[i]:starts[i+1]
+        return np.append( index['start'], INDEX_DTYPE['start'].type(num_records) )
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def revolution(self, index):
+        # returns a view of the records for a single revolution
+        if self.empty[index]:
+            return self.records[ self.starts[index] : self.starts[index] ]
+        return self.records[ self.starts[index] : self.starts[index+1] ]
+
+    def timestamp(self, index):
+        return float( self.timestamps[index] )
+
+    def iter_revolutions(self, start=0):
+        for index in range(start, len(self)):
+            yield self.revolution(index)
+
+    def close(self):
+        self.records = None
+
+#
+# Generator that reads back a scan log, yielding a (timestamp, scan) tuple for each revolution
+# where the scan is a list of (quality, angle, distance) tuples, just like iter_scans()
+#
+def read_scans(filename, start=0):
+    log = ScanLog(filename)
+    for index in range(start, len(log)):
+        records = log.revolution(index)
+        scan = list( zip( records['quality'].tolist(), records['angle'].tolist(), records['distance'].tolist() ) )
+        yield log.timestamp(index), scan
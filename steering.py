@@ -0,0 +1,238 @@
+import argparse
+import random
+import time
+
+from config import read_config
+from logger import logger
+
+#
+# Steering laws used by the LIDAR align and follow controllers. The bucket tables are the
+# original step functions that map the target angle and distance to a fixed set of speeds,
+# while the PID controller produces a continuous command.
+#
+
+#
+# Map the angle to the target (0-359 degrees) onto a turning speed, turning left (negative)
+# when the target is on the left side of the robot
+#
+def bucket_turning_speed(angle):
+    if angle < 5 or angle > 355:
+        turning_speed = 0.0
+    elif angle < 20 or angle > 340:
+        turning_speed = 0.2
+    elif angle < 90 or angle > 270:
+        turning_speed = 0.4
+    else:
+        turning_speed = 0.6
+
+    # if the angle is greater than 180, then we will turn to the left
+    if angle > 180:
+        turning_speed *= -1.0
+
+    return turning_speed
+
+#
+# Map the distance to the target onto a moving speed. The speed is negative because pushing
+# the LeftJoystickY forward drives the robot toward the target.
+#
+def bucket_moving_speed(distance, follow_distance):
+    moving_speed = 0.0
+    if distance < follow_distance + 6:
+        moving_speed = 0.0
+    elif distance < follow_distance + 12:
+        moving_speed = 0.2
+    elif distance < follow_distance + 36:
+        moving_speed = 0.3
+    elif distance < follow_distance + 48:
+        moving_speed = 0.4
+    else:
+        moving_speed = 0.6
+
+    return moving_speed * -1.0
+
+#
+# Convert an angle in the range 0-359 degrees into a signed offset from straight ahead
+#
+def signed_angle(angle):
+    return ((angle + 180.0) % 360.0) - 180.0
+
+#
+# PID controller with output clamping, integral windup protection and slew-rate limiting.
+#
+# The integral term is bounded by integral_limit and is not accumulated while the output is
+# saturated in the direction of the error. The slew rate limits how much the output can change
+# per second, which avoids the abrupt speed steps that make the robot lurch. Errors inside the
+# deadband are treated as zero. The time between updates is measured with the monotonic clock,
+# using period for the very first update.
+#
+class PIDController(object):
+    def __init__(self, kp=0.0, ki=0.0, kd=0.0, output_limit=1.0, integral_limit=None, slew_rate=None,
+                 deadband=0.0, period=0.05):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_limit = output_limit
+        self.integral_limit = integral_limit
+        self.slew_rate = slew_rate
+        self.deadband = deadband
+        self.period = period
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.prev_error = None
+        self.prev_time = None
+        self.output = 0.0
+
+    def update(self, error, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        dt = self.period if self.prev_time is None else timestamp - self.prev_time
+        self.prev_time = timestamp
+
+        if abs(error) <= self.deadband:
+            error = 0.0
+
+        derivative = 0.0
+        if self.prev_error is not None and dt > 0:
+            derivative = (error - self.prev_error) / dt
+        self.prev_error = error
+
+        integral = self.integral + error * dt
+        if self.integral_limit is not None:
+            integral = max( -self.integral_limit, min(self.integral_limit, integral) )
+
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        clamped = max( -self.output_limit, min(self.output_limit, output) )
+
+        # only accept the new integral if the output isn't being pushed further into saturation
+        if clamped == output or (output > 0) != (error > 0):
+            self.integral = integral
+
+        if self.slew_rate and dt > 0:
+            max_change = self.slew_rate * dt
+            clamped = max( self.output - max_change, min(self.output + max_change, clamped) )
+
+        self.output = clamped
+        return clamped
+
+#
+# Create a PID controller from a configuration section, e.g.
+#     { "kp": 0.01, "ki": 0.0, "kd": 0.001, "output_limit": 0.6, "slew_rate": 2.0 }
+#
+def create_pid(pid_config, period=0.05):
+    return PIDController( kp=pid_config.get('kp', 0.0),
+                          ki=pid_config.get('ki', 0.0),
+                          kd=pid_config.get('kd', 0.0),
+                          output_limit=pid_config.get('output_limit', 0.6),
+                          integral_limit=pid_config.get('integral_limit', None),
+                          slew_rate=pid_config.get('slew_rate', None),
+                          deadband=pid_config.get('deadband', 0.0),
+                          period=period )
+
+#
+# Decide whether a new speed command differs enough from the last one published to be worth
+# sending. A return to zero is always published so that the robot reliably stops.
+#
+def speed_changed(new_speed, curr_speed, threshold=0.0):
+    if new_speed == curr_speed:
+        return False
+    if new_speed == 0.0:
+        return True
+    return abs(new_speed - curr_speed) >= threshold
+
+#
+# Simulated target used to compare the steering laws without a robot. The robot turns at
+# turn_rate degrees per second and drives at drive_rate inches per second at full command,
+# and every sample of the target carries some gaussian measurement noise.
+#
+def simulate_align(steer, angle=75.0, period=0.05, duration=10.0, turn_rate=180.0, noise=1.0, threshold=0.0):
+    curr_speed = 0.0
+    publishes = 0
+    aligned_time = None
+    t = 0.0
+    while t < duration:
+        measured = (angle + random.gauss(0.0, noise)) % 360.0
+        speed = steer(measured, t)
+        if speed_changed(speed, curr_speed, threshold):
+            curr_speed = speed
+            publishes += 1
+
+        angle = signed_angle(angle - curr_speed * turn_rate * period)
+        if abs(angle) < 5.0:
+            if aligned_time is None:
+                aligned_time = t
+        else:
+            aligned_time = None
+        t += period
+    return aligned_time, publishes
+
+def simulate_follow(steer, distance=150.0, follow_distance=42.0, period=0.05, duration=10.0, drive_rate=60.0,
+                    noise=1.0, threshold=0.0):
+    curr_speed = 0.0
+    publishes = 0
+    arrived_time = None
+    t = 0.0
+    while t < duration:
+        measured = distance + random.gauss(0.0, noise)
+        speed = steer(measured, t)
+        if speed_changed(speed, curr_speed, threshold):
+            curr_speed = speed
+            publishes += 1
+
+        distance += curr_speed * drive_rate * period
+        if abs(distance - follow_distance) < 6.0:
+            if arrived_time is None:
+                arrived_time = t
+        else:
+            arrived_time = None
+        t += period
+    return arrived_time, publishes
+
+
+if __name__ == '__main__':
+
+    #
+    # parse out the command arguments
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', action='store', dest='config', default='config.json')
+    parser.add_argument('-a', '--angle', action='store', dest='angle', default='75')
+    parser.add_argument('-d', '--distance', action='store', dest='distance', default='150')
+    parser.add_argument('-n', '--noise', action='store', dest='noise', default='1.0')
+    options = parser.parse_args()
+
+    config = read_config( filename=options.config )
+    steering_config = config.get('steering', {})
+    follow_distance = config.get('lidar', {}).get('follow_distance', 42)
+    threshold = steering_config.get('publish_threshold', 0.02)
+
+    #
+    # compare the time to align on (and close in on) a simulated target, and the number of
+    # speed updates that would be published, for the bucket tables and the PID controllers
+    #
+    random.seed(0)
+    align_pid = create_pid( steering_config.get('align', {}) )
+    follow_pid = create_pid( steering_config.get('follow', {}) )
+
+    results = [
+        ( 'bucket align',
+          simulate_align( lambda angle, t: bucket_turning_speed(angle),
+                          angle=float(options.angle), noise=float(options.noise) ) ),
+        ( 'pid align',
+          simulate_align( lambda angle, t: align_pid.update(signed_angle(angle), t),
+                          angle=float(options.angle), noise=float(options.noise), threshold=threshold ) ),
+        ( 'bucket follow',
+          simulate_follow( lambda distance, t: bucket_moving_speed(distance, follow_distance),
+                           distance=float(options.distance), follow_distance=follow_distance, noise=float(options.noise) ) ),
+        ( 'pid follow',
+          simulate_follow( lambda distance, t: -follow_pid.update(distance - follow_distance, t),
+                           distance=float(options.distance), follow_distance=follow_distance, noise=float(options.noise),
+                           threshold=threshold ) )
+    ]
+
+    for name, (settle_time, publishes) in results:
+        if settle_time is None:
+            logger.info( '%-14s did not settle, %d publishes' % (name, publishes) )
+        else:
+            logger.info( '%-14s settled in %0.2f seconds, %d publishes' % (name, settle_time, publishes) )
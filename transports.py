@@ -0,0 +1,453 @@
+import argparse
+import base64
+import collections
+import errno
+import hashlib
+import os
+import random
+import selectors
+import socket
+import struct
+import time
+
+from logger import logger
+
+#
+# Connection oriented transports for the XRP commands, as an alternative to UDP datagrams.
+#
+# TcpTransport sends each command as a message prefixed by its length (uint16, network byte
+# order) over a TCP connection with Nagle's algorithm disabled (TCP_NODELAY), so that a command
+# goes out as soon as it is sent. WebSocketTransport sends each command as a binary WebSocket
+# message instead, for an XRP that runs a WebSocket server.
+#
+# Both are driven without blocking by the owner of the transport: on_readable() and
+# on_writable() when the socket is ready, and poll() at least every timeout() seconds. A lost
+# connection is reestablished with an exponential backoff. Commands sent while the connection is
+# down (or can't keep up) wait in a bounded SendQueue, where a newer value of an axis replaces
+# the older one instead of being queued behind it.
+#
+LENGTH_PREFIX = struct.Struct('>H')
+
+#
+# Bounded FIFO of outgoing messages. A message put with a key replaces the queued message with
+# the same key, so only the latest value of e.g. an axis is ever waiting. When the queue is full,
+# the oldest keyed message is dropped, or the oldest message if none of them has a key.
+#
+class SendQueue(object):
+    def __init__(self, max_messages=64):
+        self.max_messages = max_messages
+        self.entries = collections.deque()
+        self.keyed = {}
+        self.num_dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, data, key=None):
+        if key is not None:
+            stale = self.keyed.get(key, None)
+            if stale is not None:
+                self.entries.remove( stale )
+                self.num_dropped += 1
+        entry = [ key, data ]
+        self.entries.append( entry )
+        if key is not None:
+            self.keyed[key] = entry
+
+        if len(self.entries) > self.max_messages:
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        for entry in self.entries:
+            if entry[0] is not None:
+                break
+        else:
+            entry = self.entries[0]
+        self.entries.remove( entry )
+        if entry[0] is not None:
+            del self.keyed[entry[0]]
+        self.num_dropped += 1
+
+    def get(self):
+        if not self.entries:
+            return None
+        key, data = self.entries.popleft()
+        if key is not None:
+            del self.keyed[key]
+        return data
+
+DISCONNECTED = 0
+CONNECTING = 1
+HANDSHAKE = 2
+CONNECTED = 3
+
+class TcpTransport(object):
+    def __init__(self, host, port, queue_size=64, min_backoff=0.1, max_backoff=5.0):
+        self.address = (host, port)
+        self.queue = SendQueue(queue_size)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.next_attempt = 0.0
+        self.state = DISCONNECTED
+        self.sock = None
+        self.out = None
+
+        # called whenever the socket or its need to write changes, see AsyncRuntime.drive_transport()
+        self.wakeup = None
+
+    def __str__(self):
+        return '%s:%d' % self.address
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def notify(self):
+        if self.wakeup:
+            self.wakeup()
+
+    def send(self, data, key=None):
+        self.queue.put( self.frame(data), key )
+        if self.state == CONNECTED:
+            self.flush()
+        self.notify()
+
+    def frame(self, data):
+        return LENGTH_PREFIX.pack( len(data) ) + data
+
+    def wants_write(self):
+        if self.state == CONNECTING:
+            return True
+        return self.sock is not None and (bool(self.out) or (self.state == CONNECTED and len(self.queue) > 0))
+
+    def timeout(self, now=None):
+        # how long until poll() has to be called to reconnect, or None if connected
+        if self.state != DISCONNECTED:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max( 0.0, self.next_attempt - now )
+
+    def poll(self, now=None):
+        if self.state == DISCONNECTED:
+            if now is None:
+                now = time.monotonic()
+            if now >= self.next_attempt:
+                self.connect()
+
+    def connect(self):
+        sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        sock.setblocking( False )
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        error = sock.connect_ex( self.address )
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.connection_lost( os.strerror(error) )
+            return
+        self.sock = sock
+        self.state = CONNECTING
+        self.notify()
+
+    def connection_made(self):
+        logger.info( 'Connected to %s' % self )
+        self.backoff = self.min_backoff
+        self.state = CONNECTED
+
+    def connection_lost(self, reason):
+        if self.state == CONNECTED or self.state == HANDSHAKE:
+            logger.info( 'Connection to %s lost: %s' % (self, reason) )
+        else:
+            logger.debug( 'Unable to connect to %s: %s' % (self, reason) )
+        sock = self.sock
+        self.sock = None
+        self.out = None
+        self.state = DISCONNECTED
+
+        # retry after the backoff, with some jitter so that several controllers don't retry in step
+        self.next_attempt = time.monotonic() + self.backoff * random.uniform(0.5, 1.0)
+        self.backoff = min( self.backoff * 2, self.max_backoff )
+
+        # let an event loop unregister the socket before it is closed
+        self.notify()
+        if sock:
+            sock.close()
+
+    def on_writable(self):
+        if self.sock is None:
+            # lost while servicing an earlier event of the same wait
+            return
+        if self.state == CONNECTING:
+            error = self.sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+            if error:
+                self.connection_lost( os.strerror(error) )
+                return
+            self.connection_made()
+        self.flush()
+        self.notify()
+
+    def on_readable(self):
+        if self.sock is None:
+            return
+        try:
+            data = self.sock.recv( 4096 )
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self.connection_lost( err.strerror )
+            return
+        if not data:
+            self.connection_lost( 'closed by peer' )
+            return
+        self.data_received( data )
+
+    def data_received(self, data):
+        # nothing is expected back from the XRP
+        pass
+
+    def flush(self):
+        while True:
+            if not self.out:
+                if self.state != CONNECTED:
+                    return
+                data = self.queue.get()
+                if data is None:
+                    return
+                self.out = memoryview( data )
+            try:
+                sent = self.sock.send( self.out )
+            except BlockingIOError:
+                return
+            except OSError as err:
+                self.connection_lost( err.strerror )
+                return
+            self.out = self.out[sent:]
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        self.state = DISCONNECTED
+
+#
+# WebSocket (RFC 6455) client transport. Only what is needed to send commands is implemented:
+# the opening handshake, masked binary messages, answering pings and noticing a close.
+#
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+def websocket_accept(key):
+    return base64.b64encode( hashlib.sha1(key + WEBSOCKET_GUID).digest() )
+
+def websocket_frame(opcode, payload, mask=True):
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack( '>BB', 0x80 | opcode, mask_bit | length )
+    elif length < 0x10000:
+        header = struct.pack( '>BBH', 0x80 | opcode, mask_bit | 126, length )
+    else:
+        header = struct.pack( '>BBQ', 0x80 | opcode, mask_bit | 127, length )
+    if not mask:
+        return header + payload
+    mask_key = os.urandom(4)
+    return header + mask_key + apply_mask( mask_key, payload )
+
+def apply_mask(mask_key, payload):
+    length = len(payload)
+    if not length:
+        return b''
+    mask = (mask_key * (length // 4 + 1))[:length]
+    return ( int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big') ).to_bytes( length, 'big' )
+
+def parse_websocket_frame(data):
+    #
+    # parse a frame from the start of data, returning (opcode, payload, frame length), or None
+    # if data doesn't hold a complete frame yet
+    #
+    if len(data) < 2:
+        return None
+    opcode = data[0] & 0x0f
+    masked = data[1] & 0x80
+    length = data[1] & 0x7f
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length = struct.unpack_from( '>H', data, 2 )[0]
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length = struct.unpack_from( '>Q', data, 2 )[0]
+        offset = 10
+    mask_key = None
+    if masked:
+        mask_key = bytes( data[offset:offset+4] )
+        offset += 4
+    if len(data) < offset + length:
+        return None
+    payload = bytes( data[offset:offset+length] )
+    if mask_key:
+        payload = apply_mask( mask_key, payload )
+    return opcode, payload, offset + length
+
+class WebSocketTransport(TcpTransport):
+    def __init__(self, host, port, path='/', queue_size=64, min_backoff=0.1, max_backoff=5.0):
+        super().__init__( host, port, queue_size, min_backoff, max_backoff )
+        self.path = path
+        self.key = None
+        self.received = bytearray()
+
+    def frame(self, data):
+        return websocket_frame( OP_BINARY, data )
+
+    def connection_made(self):
+        # the connection only becomes usable for commands once the server accepts the upgrade
+        self.key = base64.b64encode( os.urandom(16) )
+        request = ( 'GET %s HTTP/1.1\r\n'
+                    'Host: %s:%d\r\n'
+                    'Upgrade: websocket\r\n'
+                    'Connection: Upgrade\r\n'
+                    'Sec-WebSocket-Key: %s\r\n'
+                    'Sec-WebSocket-Version: 13\r\n\r\n' ) % (self.path, self.address[0], self.address[1], self.key.decode())
+        self.received = bytearray()
+        self.out = memoryview( request.encode() )
+        self.state = HANDSHAKE
+
+    def data_received(self, data):
+        self.received += data
+        if self.state == HANDSHAKE:
+            end = self.received.find( b'\r\n\r\n' )
+            if end < 0:
+                return
+            response = bytes( self.received[:end] ).split( b'\r\n' )
+            del self.received[:end+4]
+            headers = dict( line.split(b':', 1) for line in response[1:] if b':' in line )
+            accept = { name.strip().lower(): value.strip() for name, value in headers.items() }.get( b'sec-websocket-accept' )
+            if response[0].split()[1:2] != [b'101'] or accept != websocket_accept(self.key):
+                self.connection_lost( 'WebSocket upgrade refused' )
+                return
+            super().connection_made()
+            self.flush()
+            self.notify()
+
+        while self.state == CONNECTED:
+            frame = parse_websocket_frame( self.received )
+            if frame is None:
+                return
+            opcode, payload, length = frame
+            del self.received[:length]
+            if opcode == OP_PING:
+                self.queue.put( websocket_frame(OP_PONG, payload), 'pong' )
+                self.flush()
+            elif opcode == OP_CLOSE:
+                self.connection_lost( 'closed by peer' )
+
+
+if __name__ == '__main__':
+
+    #
+    # stand-in for an XRP reached over TCP or a WebSocket, reporting the messages and bytes
+    # received every second. --stall stops reading for a while after each connection, to see
+    # how the controller copes with a receiver that can't keep up
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', action='store', dest='port', default='9999')
+    parser.add_argument('-w', '--websocket', action='store_true', dest='websocket', default=False)
+    parser.add_argument('--stall', action='store', dest='stall', default='0')
+    options = parser.parse_args()
+
+    stall = float(options.stall)
+
+    selector = selectors.DefaultSelector()
+    server = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    server.bind( ('', int(options.port)) )
+    server.listen()
+    server.setblocking( False )
+    selector.register( server, selectors.EVENT_READ )
+    logger.info( 'Listening for XRP %s connections on port %s' % ('WebSocket' if options.websocket else 'TCP', options.port) )
+
+    # per connection: received bytes, upgraded flag and time until which reading is stalled
+    connections = {}
+    num_messages = 0
+    num_bytes = 0
+    last_report = time.monotonic()
+
+    try:
+        while True:
+            now = time.monotonic()
+            for conn, state in connections.items():
+                if state['stalled'] and now >= state['resume']:
+                    selector.register( conn, selectors.EVENT_READ )
+                    state['stalled'] = False
+
+            for key, _ in selector.select( 0.1 ):
+                if key.fileobj is server:
+                    conn, address = server.accept()
+                    conn.setblocking( False )
+                    logger.info( 'Connection from %s:%d' % address )
+                    connections[conn] = { 'data': bytearray(), 'upgraded': not options.websocket,
+                                          'stalled': stall > 0, 'resume': time.monotonic() + stall }
+                    if stall <= 0:
+                        selector.register( conn, selectors.EVENT_READ )
+                    continue
+
+                conn = key.fileobj
+                state = connections[conn]
+                try:
+                    data = conn.recv( 65536 )
+                except OSError:
+                    data = b''
+                if not data:
+                    logger.info( 'Connection closed' )
+                    selector.unregister( conn )
+                    del connections[conn]
+                    conn.close()
+                    continue
+                num_bytes += len(data)
+                buffer = state['data']
+                buffer += data
+
+                if not state['upgraded']:
+                    end = buffer.find( b'\r\n\r\n' )
+                    if end < 0:
+                        continue
+                    request_key = b''
+                    for line in bytes( buffer[:end] ).split( b'\r\n' ):
+                        if line.lower().startswith( b'sec-websocket-key:' ):
+                            request_key = line.split( b':', 1 )[1].strip()
+                    conn.sendall( b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                                  b'Sec-WebSocket-Accept: ' + websocket_accept(request_key) + b'\r\n\r\n' )
+                    del buffer[:end+4]
+                    state['upgraded'] = True
+
+                while True:
+                    if options.websocket:
+                        frame = parse_websocket_frame( buffer )
+                        if frame is None:
+                            break
+                        del buffer[:frame[2]]
+                    else:
+                        if len(buffer) < LENGTH_PREFIX.size:
+                            break
+                        length = LENGTH_PREFIX.unpack_from( buffer, 0 )[0]
+                        if len(buffer) < LENGTH_PREFIX.size + length:
+                            break
+                        del buffer[:LENGTH_PREFIX.size + length]
+                    num_messages += 1
+
+            if now - last_report >= 1.0:
+                if num_messages:
+                    logger.info( '%d messages, %d bytes per second' % (num_messages / (now - last_report), num_bytes / (now - last_report)) )
+                num_messages = 0
+                num_bytes = 0
+                last_report = now
+
+    except KeyboardInterrupt:
+        server.close()
@@ -10,7 +10,12 @@ import time
 from config import read_config
 
 from logger import logger
-from joystick import Joystick
+from device_manager import DeviceManager
+from joystick import Joystick, JoystickEvent, EVENT_BUTTON, EVENT_AXIS
+from runtime import AsyncRuntime
+from link_stats import LinkStats, format_stats
+from transports import TcpTransport, WebSocketTransport
+from xrp_protocol import FrameEncoder, CONTROLS, CONTROL_IDS, encode_value, decode_frame, frame_sequence
 
 # dictionary of all the xbox controller buttons and controls. By enabling or disabling
 # the controls, you can control how much extra traffic is sent down to the XRP.
@@ -35,60 +40,321 @@ controls = {
     'HatY':           { 'type': 'AXIS',   'enabled': True  }
 }
 
+#
+# Resolve the host name of an XRP once up front, rather than on every datagram sent, so that
+# acknowledgements can also be matched to the XRP by address
+#
+def resolve_target(host, port):
+    try:
+        return ( socket.gethostbyname(host), port )
+    except OSError:
+        logger.error( 'Unable to resolve XRP address: %s' % host )
+        return ( host, port )
+
 #
 # class to implement the XRP controller. This class is derived from the Joystick class
 # and supports an Xbox Controller connected via USB to a Raspberry Pi
 #
 class XrpController(Joystick):
-    def __init__(self, path=None, socket_type='UDP', host='', team_number=9999):
+    def __init__(self, path=None, socket_type='UDP', host='', team_number=9999, protocol='ascii', state_rate=20,
+                 stats_interval=10.0):
         super().__init__(path)
 
-        signal.signal(signal.SIGINT, self.shutdown)
-        signal.signal(signal.SIGTERM, self.shutdown)
-
         self.host = host
-        self.port = team_number
+        self.port = int(team_number)
         self.socket_type = socket_type
 
-        # create a socket based on the requested type
+        # commands are sent as 'Event:<name>:<value>' strings with the ascii protocol, or
+        # batched into one frame per gamepad report with the binary protocol, see xrp_protocol.py.
+        # With the state protocol, the value of every control is sent in a state frame state_rate
+        # times per second, and at the end of each gamepad report that changed any of them, so
+        # the XRP recovers from a lost datagram with the next one
+        self.protocol = protocol
+        self.state_period = 1.0 / state_rate
+
+        # the first gamepad slot is driven by the controller itself and sends to host:port,
+        # further slots are added by configure_gamepads()
+        self.slot_joysticks = [ self ]
+        self.slot_targets = [ resolve_target(self.host, self.port) ]
+        self.slot_encoders = [ FrameEncoder() ]
+        self.slot_stats = [ LinkStats() ]
+        self.slot_states = [ [0] * len(CONTROLS) ]
+        self.slot_changed = [ False ]
+        self.hotplug = True
+
+        # the binary protocols number and timestamp every frame, and the link statistics are
+        # logged every stats_interval seconds from the acknowledgements the XRP sends back.
+        # The 'Event:<name>:<value>' strings of the ascii protocol carry neither, and existing
+        # XRP programs parse them as they are, so the link statistics are off for that protocol
+        # rather than reporting figures that mean nothing
+        self.stats_interval = stats_interval if protocol != 'ascii' else 0
+        if protocol == 'ascii' and stats_interval:
+            logger.info( 'XRP link statistics need the binary or state protocol, disabled for ascii' )
+        self.last_report = time.monotonic()
+
+        # datagram transport used in place of the socket when running on the asyncio runtime
+        self.transport = None
+
+        # create a socket based on the requested type. The TCP and WEBSOCKET types use one
+        # connection per gamepad slot, see transports.py
+        self.slot_connections = []
         if self.socket_type == 'UDP':
             self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        elif self.socket_type in ('TCP', 'WEBSOCKET'):
+            self.slot_connections.append( self.create_connection(self.slot_targets[0]) )
+        else:
+            logger.error( 'Unsupported Socket Type: %s' % self.socket_type )
+
+    def install_signal_handlers(self):
+        # for the threaded controller only, AsyncRuntime handles the signals on its own loop
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
 
     def shutdown( self, *args ):
         logger.info( 'Shutdown complete.' )
 
         sys.exit(0)
 
-    def send_event( self, event ):
+    def send_event( self, event, slot=0 ):
+        if event.kind != EVENT_BUTTON and event.kind != EVENT_AXIS:
+            return
+
         command = None
-        name = event['name']
+        name = event.name
         try:
             control = controls[name]
 
             if control.get('enabled', False) == True:
-                if control['type'] == 'AXIS':
+                if self.protocol == 'state':
+                    # the state is sent at the end of the frame if it changed, see flush_frame()
+                    state = self.slot_states[slot]
+                    control_id = CONTROL_IDS[name]
+                    value = encode_value( event.value, control['type'] == 'AXIS' )
+                    if state[control_id] != value:
+                        state[control_id] = value
+                        self.slot_changed[slot] = True
+                elif self.protocol == 'binary':
+                    # the value is sent along with the rest of the frame, see flush_frame()
+                    self.slot_encoders[slot].add( name, event.value, control['type'] == 'AXIS' )
+                elif control['type'] == 'AXIS':
                     # for the axis type, send the value rounded to the nearest 2 decimal points
-                    value = event['rounded_value']
+                    value = event.rounded_value
                     command = '%s:%s:%f' % ('Event',name, value) 
                 elif control['type'] == 'BUTTON':
                     # for the button type, send the value reported by the button (1:PRESSED or 0:RELEASED)
-                    value = event['value']
+                    value = event.value
                     command = '%s:%s:%d' % ('Event',name, value) 
                 else:
                     logger.error( 'Unknown Event Type: %s' % name )
 
                 if command:
                     logger.debug( 'Sending: %s' % command )
-                    if self.socket_type == 'UDP':
-                        self.socket.sendto( command.encode('utf-8'), (self.host,self.port) )
+                    # a queued axis value is replaced by a newer one, button changes are all sent
+                    key = name if control['type'] == 'AXIS' else None
+                    self.send_command( command.encode('utf-8'), slot, key )
 
         except KeyError:
             pass
 
+    def flush_frame( self, slot=0 ):
+        # send the values collected during a gamepad report as a single datagram, which with
+        # the state protocol is the complete state if anything changed
+        if self.protocol == 'state':
+            if self.slot_changed[slot]:
+                self.send_state( slot )
+            return
+        data = self.slot_encoders[slot].encode()
+        if data:
+            self.send_frame( data, slot )
+
+    def send_state( self, slot=0 ):
+        self.slot_changed[slot] = False
+        # a queued state frame is superseded by the next one
+        self.send_frame( self.slot_encoders[slot].encode_state(self.slot_states[slot]), slot, 'state' )
+
+    def send_frame( self, data, slot=0, key=None ):
+        now = time.monotonic()
+        stats = self.slot_stats[slot]
+        self.send_command( data, slot, key )
+        stats.sent( frame_sequence(data), now )
+        if self.transport:
+            stats.sample_queue_depth( self.transport.get_extra_info('socket') )
+        elif self.socket_type == 'UDP':
+            stats.sample_queue_depth( self.socket )
+        elif self.slot_connections and self.slot_connections[slot].sock:
+            stats.sample_queue_depth( self.slot_connections[slot].sock )
+
+        if self.stats_interval and now - self.last_report >= self.stats_interval:
+            self.report_stats( now )
+
+    def receive_datagram( self, data, address ):
+        # match an acknowledgement (or echo) of a frame from an XRP to the frame that was sent
+        try:
+            frame = decode_frame( data )
+        except ValueError as err:
+            logger.debug( 'Invalid datagram from %s: %s' % (address[0], err) )
+            return
+        if address in self.slot_targets:
+            slot = self.slot_targets.index( address )
+        elif len(self.slot_targets) == 1:
+            slot = 0
+        else:
+            return
+        self.slot_stats[slot].received( frame.sequence )
+
+    def receive_pending( self ):
+        while True:
+            try:
+                data, address = self.socket.recvfrom( 1024, socket.MSG_DONTWAIT )
+            except BlockingIOError:
+                break
+            except OSError as err:
+                # e.g. an ICMP port unreachable reported for an earlier datagram
+                logger.debug( 'Receive failed: %s' % err )
+                break
+            self.receive_datagram( data, address )
+
+    def report_stats( self, now=None ):
+        self.last_report = time.monotonic() if now is None else now
+        for slot, stats in enumerate(self.slot_stats):
+            report = stats.report( self.last_report )
+            if report['sent']:
+                logger.info( 'XRP link %d: %s' % (slot, format_stats(report)) )
+
+    def refresh_state( self ):
+        # periodic resend of the complete state of every gamepad slot
+        for slot in range(len(self.slot_states)):
+            self.send_state( slot )
+
+    def send_command( self, data, slot=0, key=None ):
+        if self.transport:
+            self.transport.sendto( data, self.slot_targets[slot] )
+        elif self.socket_type == 'UDP':
+            self.socket.sendto( data, self.slot_targets[slot] )
+        elif self.slot_connections:
+            self.slot_connections[slot].send( data, key )
+
+    def create_connection( self, target ):
+        if self.socket_type == 'WEBSOCKET':
+            return WebSocketTransport( target[0], target[1] )
+        return TcpTransport( target[0], target[1] )
+
+    def connection_timeout( self ):
+        # how long the input pump may wait before a connection has to be polled to reconnect
+        timeouts = [ timeout for timeout in (c.timeout() for c in self.slot_connections) if timeout is not None ]
+        return min(timeouts) if timeouts else None
+
+    def configure_gamepads( self, gamepad_config ):
+        #
+        # configure the gamepad slots after the first, listing the XRP that each further gamepad
+        # drives, e.g. { "targets": [ { "host": "192.168.1.12", "port": 9999 } ] }. hotplug
+        # enables watching for gamepads being connected and disconnected while running
+        #
+        self.hotplug = gamepad_config.get('hotplug', True)
+        for target in gamepad_config.get('targets', []):
+            joystick = Joystick( probe=False )
+            joystick.configure_axis_filters( self.filter_config )
+            self.slot_joysticks.append( joystick )
+            self.slot_targets.append( resolve_target(target['host'], int(target.get('port', self.port))) )
+            self.slot_encoders.append( FrameEncoder() )
+            self.slot_stats.append( LinkStats() )
+            if self.socket_type in ('TCP', 'WEBSOCKET'):
+                self.slot_connections.append( self.create_connection(self.slot_targets[-1]) )
+            self.slot_states.append( [0] * len(CONTROLS) )
+            self.slot_changed.append( False )
+
+    def create_device_manager( self ):
+        manager = DeviceManager( self.slot_joysticks, self.SUPPORTED_DEVICES, hotplug=self.hotplug )
+        manager.listeners.append( self.gamepad_changed )
+        manager.start()
+        return manager
+
+    def gamepad_changed( self, slot, device ):
+        #
+        # when a gamepad is disconnected, release all of its buttons and center all of its axes
+        # so that the XRP it was driving doesn't keep moving
+        #
+        if device:
+            return
+        released = JoystickEvent()
+        released.value = 0
+        for name, control in controls.items():
+            released.kind = EVENT_AXIS if control['type'] == 'AXIS' else EVENT_BUTTON
+            released.name = name
+            self.send_event( released, slot )
+        self.flush_frame( slot )
+
+    def process_frame( self, frame, slot=0 ):
+        for decoded_event in frame:
+            self.send_event( decoded_event, slot )
+        self.flush_frame( slot )
+
     def joystick_control(self):
-        for event in self.gamepad.read_loop():
-            decoded_event = self.decode_event( event )
-            self.send_event( decoded_event )
+        manager = self.create_device_manager()
+        refresh_timeout = None
+        if self.protocol == 'state':
+            next_refresh = time.monotonic()
+            refresh_timeout = lambda: max( 0.0, next_refresh - time.monotonic() )
+
+        readers = None
+        writers = None
+        if self.socket_type == 'UDP' and self.protocol != 'ascii':
+            readers = { self.socket: self.receive_pending }
+        elif self.slot_connections:
+            # the connections come and go, so their sockets are collected on every wait
+            readers = lambda: { c: c.on_readable for c in self.slot_connections if c.sock }
+            writers = lambda: { c: c.on_writable for c in self.slot_connections if c.wants_write() }
+
+        def timeout():
+            timeouts = [ t for t in (refresh_timeout and refresh_timeout(), self.connection_timeout()) if t is not None ]
+            return min(timeouts) if timeouts else None
+
+        try:
+            for slot, frame in manager.read_frames( timeout, readers, writers ):
+                for connection in self.slot_connections:
+                    connection.poll()
+
+                if frame is not None:
+                    self.process_frame( frame, slot )
+
+                if refresh_timeout and refresh_timeout() == 0.0:
+                    self.refresh_state()
+                    # keep to the fixed rate, without a burst of refreshes after a stall
+                    now = time.monotonic()
+                    next_refresh += self.state_period
+                    if next_refresh <= now:
+                        next_refresh = now + self.state_period
+        finally:
+            manager.close()
+            for connection in self.slot_connections:
+                connection.close()
+
+    async def joystick_control_async(self, runtime):
+        # asyncio version of joystick_control, sending through a datagram endpoint on the loop
+        if self.socket_type == 'UDP':
+            self.transport = await runtime.open_udp( self.receive_datagram )
+        manager = self.create_device_manager()
+
+        refresh_timer = None
+        def refresh():
+            nonlocal refresh_timer
+            self.refresh_state()
+            refresh_timer = runtime.loop.call_later( self.state_period, refresh )
+        if self.protocol == 'state':
+            refresh()
+
+        drivers = [ runtime.loop.create_task(runtime.drive_transport(c)) for c in self.slot_connections ]
+        try:
+            await runtime.pump_gamepads( manager, lambda slot, frame: self.process_frame(frame, slot) )
+        finally:
+            if refresh_timer:
+                refresh_timer.cancel()
+            for driver in drivers:
+                driver.cancel()
+            manager.close()
+            if self.transport:
+                self.transport.close()
+                self.transport = None
 
 if __name__ == '__main__':
 
@@ -101,6 +367,7 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--socket', action='store', dest='socket_type', default=None)
     parser.add_argument('-t', '--team', action='store', dest='team', default=None)
     parser.add_argument('-x', '--xrp', action='store', dest='xrp_ipaddr', default=None)
+    parser.add_argument('-p', '--protocol', action='store', dest='protocol', default=None)
     options = parser.parse_args()
 
     #
@@ -130,15 +397,29 @@ if __name__ == '__main__':
     else:
         socket_type = config.get('socket_type', 'UDP').upper()
 
+    if options.protocol:
+        protocol = options.protocol.lower()
+    else:
+        protocol = config.get('protocol', 'ascii').lower()
+
     #
     # Create the XRP controller instance
-    controller = XrpController(socket_type=socket_type, host=xrp_ipaddr, team_number=team)
+    controller = XrpController(socket_type=socket_type, host=xrp_ipaddr, team_number=team, protocol=protocol,
+                               state_rate=config.get('state_rate', 20), stats_interval=config.get('stats_interval', 10.0))
+    controller.configure_axis_filters( config.get('axis_filters', None) )
+    controller.configure_gamepads( config.get('gamepads', {}) )
 
     try:
         # invoke the controller type as configured. Initially, an Xbox Controller is supported,
         # but other controller methods will be added over time
         if config['controller'] == 'joystick':
-            controller.joystick_control()
+            if config.get('runtime', 'threaded') == 'asyncio':
+                runtime = AsyncRuntime()
+                runtime.run( controller.joystick_control_async(runtime) )
+                logger.info( 'Shutdown complete.' )
+            else:
+                controller.install_signal_handlers()
+                controller.joystick_control()
         else:
             logger.error( 'ERROR: No Controller Type Specified' )
             sys.exit(1)
@@ -0,0 +1,227 @@
+import argparse
+import heapq
+import random
+import select
+import socket
+import struct
+import time
+from collections import namedtuple
+
+from logger import logger
+
+#
+# Binary wire protocol for the commands sent to the XRP, as an alternative to the ASCII
+# 'Event:<name>:<value>' strings.
+#
+# Each datagram holds one frame: a fixed header followed by count control entries, all little
+# endian:
+#
+#     version (uint8), message type (uint8), count (uint8), sequence (uint16), timestamp (uint32)
+#     control id (uint8), value (int16)    - repeated count times
+#
+# The sequence number increments with every frame sent and the timestamp is the sender's
+# monotonic clock in milliseconds, both wrapping around. The control id is the position of the
+# control in CONTROLS. Axis values are scaled from -1.0..1.0 to -32767..32767, button values are
+# sent as is (1:PRESSED or 0:RELEASED). A receiver checks the version byte first and drops the
+# frames of a protocol version it doesn't support, so both ends can be upgraded independently.
+#
+# A state frame (MSG_STATE) carries the value of every control instead of the ones that changed.
+# The entries are left out, the header is followed by one int16 value per control in control id
+# order. As each state frame is complete on its own, a lost frame is repaired by the next one.
+#
+# The robot may acknowledge a frame by sending back its header with the message type changed to
+# MSG_ACK and a count of 0, or by echoing the whole frame, which the sender uses to measure the
+# round trip time and the loss on the link, see link_stats.py.
+#
+PROTOCOL_VERSION = 1
+
+MSG_EVENTS = 1
+MSG_STATE = 2
+MSG_ACK = 3
+
+FRAME_HEADER = struct.Struct('<BBBHI')
+FRAME_ENTRY = struct.Struct('<Bh')
+
+# the most entries in a single frame, enough for every control to change at once
+MAX_ENTRIES = 32
+
+AXIS_SCALE = 32767
+
+# (name, is_axis) for each control id
+CONTROLS = (
+    ( 'ButtonA',        False ),
+    ( 'ButtonB',        False ),
+    ( 'ButtonX',        False ),
+    ( 'ButtonY',        False ),
+    ( 'LeftBumper',     False ),
+    ( 'RightBumper',    False ),
+    ( 'Select',         False ),
+    ( 'Start',          False ),
+    ( 'LeftThumb',      False ),
+    ( 'RightThumb',     False ),
+    ( 'LeftJoystickX',  True ),
+    ( 'LeftJoystickY',  True ),
+    ( 'LeftTrigger',    True ),
+    ( 'RightJoystickX', True ),
+    ( 'RightJoystickY', True ),
+    ( 'RightTrigger',   True ),
+    ( 'HatX',           True ),
+    ( 'HatY',           True )
+)
+
+CONTROL_IDS = { name: control_id for control_id, (name, _) in enumerate(CONTROLS) }
+
+STATE_VALUES = struct.Struct( '<%dh' % len(CONTROLS) )
+
+Frame = namedtuple('Frame', ['version', 'msg_type', 'sequence', 'timestamp', 'entries'])
+
+def encode_value(value, is_axis):
+    if is_axis:
+        return max( -AXIS_SCALE, min(AXIS_SCALE, int(round(value * AXIS_SCALE))) )
+    return int(value)
+
+#
+# FrameEncoder collects control values and packs them into a frame. The frame is built in a
+# preallocated buffer, and a value that is added twice before the frame is encoded is only sent
+# once, with its latest value.
+#
+class FrameEncoder(object):
+    def __init__(self, version=PROTOCOL_VERSION):
+        self.version = version
+        self.sequence = 0
+        self.buffer = bytearray( FRAME_HEADER.size + MAX_ENTRIES * FRAME_ENTRY.size )
+        self.values = {}
+
+    def add(self, name, value, is_axis):
+        control_id = CONTROL_IDS.get(name, None)
+        if control_id is None:
+            return
+        self.values[control_id] = encode_value( value, is_axis )
+
+    def pending(self):
+        return len(self.values)
+
+    def encode(self, msg_type=MSG_EVENTS, timestamp=None):
+        # return the frame holding the values added since the last call, or None if there are none
+        if not self.values:
+            return None
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        offset = FRAME_HEADER.size
+        for control_id, value in self.values.items():
+            FRAME_ENTRY.pack_into( self.buffer, offset, control_id, value )
+            offset += FRAME_ENTRY.size
+        self.pack_header( msg_type, len(self.values), timestamp )
+        self.values.clear()
+        return bytes( self.buffer[:offset] )
+
+    def encode_state(self, state, timestamp=None):
+        # return a state frame holding the encoded value of every control, in control id order
+        if timestamp is None:
+            timestamp = time.monotonic()
+        STATE_VALUES.pack_into( self.buffer, FRAME_HEADER.size, *state )
+        self.pack_header( MSG_STATE, len(state), timestamp )
+        return bytes( self.buffer[:FRAME_HEADER.size + STATE_VALUES.size] )
+
+    def pack_header(self, msg_type, count, timestamp):
+        FRAME_HEADER.pack_into( self.buffer, 0, self.version, msg_type, count,
+                                self.sequence, int(timestamp * 1000) & 0xffffffff )
+        self.sequence = (self.sequence + 1) & 0xffff
+
+def frame_sequence(data):
+    return FRAME_HEADER.unpack_from( data, 0 )[3]
+
+def encode_ack(data):
+    # acknowledgement of a received frame, echoing its sequence number and timestamp
+    version, _, _, sequence, timestamp = FRAME_HEADER.unpack_from( data, 0 )
+    return FRAME_HEADER.pack( version, MSG_ACK, 0, sequence, timestamp )
+
+#
+# Decode a frame into a Frame holding the (name, value) entries, with the axis values scaled
+# back to -1.0..1.0. Raises ValueError for a truncated frame or an unsupported version.
+#
+def decode_frame(data):
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError( 'Truncated frame header' )
+    version, msg_type, count, sequence, timestamp = FRAME_HEADER.unpack_from( data, 0 )
+    if version != PROTOCOL_VERSION:
+        raise ValueError( 'Unsupported protocol version: %d' % version )
+
+    entries = []
+    if msg_type == MSG_ACK:
+        return Frame( version, msg_type, sequence, timestamp / 1000.0, entries )
+    if msg_type == MSG_STATE:
+        if count != len(CONTROLS) or len(data) < FRAME_HEADER.size + STATE_VALUES.size:
+            raise ValueError( 'Truncated state frame' )
+        for (name, is_axis), value in zip( CONTROLS, STATE_VALUES.unpack_from(data, FRAME_HEADER.size) ):
+            entries.append( (name, value / AXIS_SCALE if is_axis else value) )
+        return Frame( version, msg_type, sequence, timestamp / 1000.0, entries )
+
+    if len(data) < FRAME_HEADER.size + count * FRAME_ENTRY.size:
+        raise ValueError( 'Truncated frame, expected %d entries' % count )
+
+    for control_id, value in FRAME_ENTRY.iter_unpack( data[FRAME_HEADER.size:FRAME_HEADER.size + count * FRAME_ENTRY.size] ):
+        if control_id >= len(CONTROLS):
+            raise ValueError( 'Unknown control id: %d' % control_id )
+        name, is_axis = CONTROLS[control_id]
+        entries.append( (name, value / AXIS_SCALE if is_axis else value) )
+
+    return Frame( version, msg_type, sequence, timestamp / 1000.0, entries )
+
+
+if __name__ == '__main__':
+
+    #
+    # stand-in for the XRP that receives and prints the binary frames sent by the XRP
+    # controller, e.g. run with the controller pointed at localhost. With --ack, every frame
+    # is acknowledged after the given delay, with the given fraction of the acknowledgements
+    # dropped, to exercise the link statistics of the controller without a robot
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', action='store', dest='port', default='9999')
+    parser.add_argument('-a', '--ack', action='store_true', dest='ack', default=False)
+    parser.add_argument('--delay', action='store', dest='delay', default='0')
+    parser.add_argument('--drop', action='store', dest='drop', default='0')
+    parser.add_argument('-q', '--quiet', action='store_true', dest='quiet', default=False)
+    options = parser.parse_args()
+
+    delay = float(options.delay)
+    drop = float(options.drop)
+
+    sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sock.bind( ('', int(options.port)) )
+    logger.info( 'Listening for XRP frames on port %s' % options.port )
+
+    # acknowledgements waiting for their delay to expire, as (due time, ack, address)
+    pending_acks = []
+
+    try:
+        while True:
+            timeout = None
+            if pending_acks:
+                timeout = max( 0.0, pending_acks[0][0] - time.monotonic() )
+            readable, _, _ = select.select( [sock], [], [], timeout )
+
+            now = time.monotonic()
+            while pending_acks and pending_acks[0][0] <= now:
+                _, ack, address = heapq.heappop( pending_acks )
+                sock.sendto( ack, address )
+
+            if not readable:
+                continue
+
+            data, address = sock.recvfrom( 1024 )
+            try:
+                frame = decode_frame( data )
+            except ValueError as err:
+                logger.error( 'Invalid frame from %s: %s' % (address[0], err) )
+                continue
+            if not options.quiet:
+                logger.info( 'Frame %d (%d bytes) at %0.3f: %s' % (frame.sequence, len(data), frame.timestamp,
+                             ', '.join( '%s=%s' % (name, round(value, 3)) for name, value in frame.entries )) )
+
+            if options.ack and random.random() >= drop:
+                heapq.heappush( pending_acks, (now + delay, encode_ack(data), address) )
+    except KeyboardInterrupt:
+        sock.close()